@@ -0,0 +1,217 @@
+import json
+import multiprocessing
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+TS_PACKET_SIZE = 188
+# A null packet: sync byte, PID 0x1FFF, payload only
+NULL_PACKET = bytes([0x47, 0x1f, 0xff, 0x10]) + b'\xff' * (TS_PACKET_SIZE - 4)
+
+
+class CourseLayout():
+    def __init__(self, course_id:int=1, sections:int=4, lessons:int=20, segments:int=30, segment_size:int=512*1024,
+                 segment_duration:float=4.0, variants:tuple[int]=(360, 720, 1080), captions:tuple[str]=("en_US", "es_ES"),
+                 articles:int=0, sample:bytes=None) -> None:
+        self.course_id = course_id
+        self.sections = sections
+        self.lessons = lessons
+        self.segments = segments
+        self.segment_duration = segment_duration
+        self.variants = variants
+        self.captions = captions
+        self.articles = articles
+
+        # Every segment is the same payload, a real sample lets ffmpeg mux it
+        if sample is None:
+            sample = NULL_PACKET * max(1, segment_size // TS_PACKET_SIZE)
+        self.segment = sample
+
+    def lesson_ids(self) -> list[int]:
+        return [self.course_id * 1000 + i for i in range(1, self.lessons + 1)]
+
+    def article_ids(self) -> list[int]:
+        return [self.course_id * 1000 + 500 + i for i in range(1, self.articles + 1)]
+
+
+# Serves the api-2.0 responses the downloader reads plus HLS playlists,
+# segments and captions for a synthetic course, with optional latency,
+# per connection bandwidth and injected errors.
+class FakeCdnHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    layout:CourseLayout = None
+    latency = 0.0
+    bandwidth = 0
+    error_rate = 0.0
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    @property
+    def origin(self) -> str:
+        return f"http://{self.headers.get('Host')}"
+
+    def do_GET(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = urlsplit(self.path).path
+        routes = [
+            (r'/api-2\.0/users/me/subscribed-courses/$', self.purchased_courses),
+            (r'/api-2\.0/courses/(\d+)/subscriber-curriculum-items/$', self.curriculum),
+            (r'/api-2\.0/courses/(\d+)/$', self.course),
+            (r'/api-2\.0/users/me/subscribed-courses/(\d+)/lectures/(\d+)/$', self.lecture),
+            (r'/hls/(\d+)/master\.m3u8$', self.master_playlist),
+            (r'/hls/(\d+)/(\d+)/index\.m3u8$', self.media_playlist),
+            (r'/hls/(\d+)/(\d+)/segment(\d+)\.ts$', self.segment),
+            (r'/captions/(\d+)/(\w+)\.vtt$', self.caption),
+            (r'/api-2\.0/assets/(\d+)/$', self.article),
+            (r'/images/(\d+)/(\d+)\.png$', self.image),
+        ]
+        for pattern, route in routes:
+            match = re.match(pattern, path)
+            if match:
+                # Only media is failed on purpose, the api is not what is being measured
+                if self.error_rate and path.startswith('/hls/') and random.random() < self.error_rate:
+                    self.send_body(b'', status=503)
+                    return
+                route(*match.groups())
+                return
+        self.send_body(b'not found', status=404)
+
+    def send_body(self, body:bytes, content_type:str="application/octet-stream", status:int=200) -> None:
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get('Range')
+        if range_header and status == 200:
+            match = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(body)}")
+                self.send_header('Content-Length', "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', "bytes")
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(body)}")
+        self.end_headers()
+        self.write_throttled(body[start:end + 1])
+
+    def write_throttled(self, body:bytes) -> None:
+        if not self.bandwidth:
+            self.wfile.write(body)
+            return
+        chunk_size = 16 * 1024
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / self.bandwidth)
+
+    def send_json(self, data:dict) -> None:
+        self.send_body(json.dumps(data).encode(), "application/json")
+
+    def purchased_courses(self) -> None:
+        self.send_json({"results": [{"_class": "course", "id": self.layout.course_id,
+                                     "title": "Benchmark Course", "url": "/course/benchmark-course/"}]})
+
+    def course(self, course_id:str) -> None:
+        self.send_json({"_class": "course", "id": int(course_id), "title": "Benchmark Course", "url": "/course/benchmark-course/"})
+
+    def curriculum(self, course_id:str) -> None:
+        results = []
+        lessons = [(lesson_id, "Video") for lesson_id in self.layout.lesson_ids()] + \
+                  [(lesson_id, "Article") for lesson_id in self.layout.article_ids()]
+        per_section = -(-len(lessons) // self.layout.sections)
+        for section in range(self.layout.sections):
+            results.append({"_class": "chapter", "id": section + 1, "object_index": section + 1, "title": f"Section {section + 1}"})
+            for index, (lesson_id, asset_type) in enumerate(lessons[section * per_section:(section + 1) * per_section]):
+                asset = {"_class": "asset", "id": lesson_id, "asset_type": asset_type, "title": "", "filename": "", "is_external": False}
+                if asset_type == "Video":
+                    asset.update(title=f"lecture-{lesson_id}.mp4", filename=f"lecture-{lesson_id}.mp4")
+                results.append({"_class": "lecture", "id": lesson_id, "object_index": section * per_section + index + 1,
+                                "title": f"Lecture {lesson_id}", "asset": asset})
+        self.send_json({"count": len(results), "next": None, "previous": None, "results": results})
+
+    def lecture(self, course_id:str, lesson_id:str) -> None:
+        captions = [{"_class": "caption", "id": int(lesson_id) * 100 + i, "file_name": f"{lesson_id}_{locale}.vtt",
+                     "locale_id": locale, "url": f"{self.origin}/captions/{lesson_id}/{locale}.vtt",
+                     "video_label": locale.split('_')[0].title()}
+                    for i, locale in enumerate(self.layout.captions)]
+        self.send_json({"_class": "lecture", "id": int(lesson_id),
+                        "asset": {"_class": "asset", "id": int(lesson_id), "asset_type": "Video",
+                                  "media_sources": [{"type": "application/x-mpegURL", "src": f"{self.origin}/hls/{lesson_id}/master.m3u8", "label": "auto"}],
+                                  "captions": captions}})
+
+    def article(self, asset_id:str) -> None:
+        paragraphs = ''.join(f"<p>Paragraph {i} with <strong>bold</strong>, <em>emphasis</em> and <code>code_{i}</code>.</p>"
+                             f"<ul><li>First point</li><li>Second point <a href=\"https://example.com/{i}\">link</a></li></ul>"
+                             for i in range(20))
+        images = ''.join(f"<figure><img src=\"{self.origin}/images/{asset_id}/{i}.png\" alt=\"figure {i}\"></figure>" for i in range(3))
+        body = f"<h2>Article {asset_id}</h2>{paragraphs}<pre>def main():\n    return 0</pre>{images}"
+        self.send_json({"_class": "asset", "id": int(asset_id), "asset_type": "Article", "title": "", "body": body})
+
+    def image(self, asset_id:str, index:str) -> None:
+        self.send_body(b'\x89PNG\r\n\x1a\n' + bytes(4096), "image/png")
+
+    def master_playlist(self, lesson_id:str) -> None:
+        lines = ["#EXTM3U"]
+        for height in self.layout.variants:
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={height * 4000},RESOLUTION={height * 16 // 9}x{height},FRAME-RATE=30,CODECS=\"avc1.4d401f,mp4a.40.2\"")
+            lines.append(f"{height}/index.m3u8")
+        self.send_body(('\n'.join(lines) + '\n').encode(), "application/vnd.apple.mpegurl")
+
+    def media_playlist(self, lesson_id:str, height:str) -> None:
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(self.layout.segment_duration + 1)}", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for index in range(self.layout.segments):
+            lines += [f"#EXTINF:{self.layout.segment_duration:.3f},", f"segment{index}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        self.send_body(('\n'.join(lines) + '\n').encode(), "application/vnd.apple.mpegurl")
+
+    def segment(self, lesson_id:str, height:str, index:str) -> None:
+        self.send_body(self.layout.segment, "video/mp2t")
+
+    def caption(self, lesson_id:str, locale:str) -> None:
+        cues = ''.join(f"\n{i}\n00:00:{i:02d}.000 --> 00:00:{i + 1:02d}.000\nLine {i}\n" for i in range(30))
+        self.send_body(("WEBVTT\n" + cues).encode(), "text/vtt")
+
+
+def serve(layout:CourseLayout, host:str, port:int, latency:float, bandwidth:int, error_rate:float, connection) -> None:
+    handler = type('Handler', (FakeCdnHandler,), {"layout": layout, "latency": latency, "bandwidth": bandwidth, "error_rate": error_rate})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    connection.send(server.server_address[:2])
+    connection.close()
+    server.serve_forever()
+
+
+# The server runs in its own process, so its memory and its threads do not
+# count against the downloader being measured.
+class FakeCdn():
+    def __init__(self, layout:CourseLayout, host:str="127.0.0.1", port:int=0, latency:float=0.0, bandwidth:int=0, error_rate:float=0.0) -> None:
+        self.address = None
+        self.connection, child_connection = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=serve, name="fake-cdn", daemon=True,
+                                               args=(layout, host, port, latency, bandwidth, error_rate, child_connection))
+
+    @property
+    def url(self) -> str:
+        host, port = self.address
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeCdn":
+        self.process.start()
+        self.address = self.connection.recv()
+        self.connection.close()
+        return self
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "udown"))
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from fakecdn import CourseLayout, FakeCdn
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Downloads a synthetic course from a local stand-in for the api and CDN and reports throughput.")
+    layout = parser.add_argument_group("course")
+    layout.add_argument('--lessons', type=int, default=20)
+    layout.add_argument('--sections', type=int, default=4)
+    layout.add_argument('--segments', type=int, default=30, help="segments per lesson")
+    layout.add_argument('--segment-size', type=int, default=512, help="KiB per segment")
+    layout.add_argument('--articles', type=int, default=0, help="article lessons besides the videos")
+    layout.add_argument('--captions', default="en_US,es_ES", help="comma separated caption locales")
+    layout.add_argument('--sample', default=None, help=".ts file served as every segment, needed for ffmpeg to have something to mux")
+
+    server = parser.add_argument_group("server")
+    server.add_argument('--latency', type=float, default=0.0, help="ms added to every response")
+    server.add_argument('--bandwidth', type=int, default=0, help="KiB/s per connection, 0 for unlimited")
+    server.add_argument('--error-rate', type=float, default=0.0, help="share of playlist and segment requests answered with 503")
+
+    downloader = parser.add_argument_group("downloader")
+    downloader.add_argument('--set', action='append', default=[], metavar="SECTION.KEY=JSON",
+                            help="override a settings.json value, e.g. downloads.threads=8 or downloads.engine='\"asyncio\"'")
+    downloader.add_argument('--mux', action='store_true', help="also mux the lessons, needs a muxable --sample")
+    downloader.add_argument('--ffmpeg', default=None, help="ffmpeg binary used for muxing")
+
+    parser.add_argument('--output', default=None, help="append the result as a json line to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary download directory")
+    return parser.parse_args()
+
+
+def write_settings(directory:str, base_url:str, args:argparse.Namespace) -> None:
+    with open(os.path.join(REPO, "settings.json"), 'r') as f:
+        settings = json.loads(f.read())
+
+    settings['auth'] = "cookies"
+    settings['cookies'] = "cookies.json"
+    settings['xhr_headers'] = os.path.join(REPO, "headers.txt")
+    settings['cache']['directory'] = ".ud_cache"
+    settings['downloads']['location'] = "downloads/$course-slug/$ind-section-slug/$ind-lesson-slug.$ext"
+    settings['downloads']['work_directory'] = ".ud_work"
+    settings.setdefault('api', {}).update({"transport": "http", "base_url": base_url})
+    settings.setdefault('metrics', {}).update({"report_file": ".ud_metrics.jsonl", "prometheus_file": None})
+    if args.ffmpeg:
+        settings['downloads']['ffmpeg_path'] = args.ffmpeg
+
+    for override in args.set:
+        key, _, value = override.partition('=')
+        section, _, name = key.partition('.')
+        settings.setdefault(section, {})[name] = json.loads(value)
+
+    with open(os.path.join(directory, "settings.json"), 'w') as f:
+        f.write(json.dumps(settings, indent=4))
+    with open(os.path.join(directory, "cookies.json"), 'w') as f:
+        f.write(json.dumps([{"name": "access_token", "value": "benchmark", "domain": "127.0.0.1", "path": "/"}]))
+
+
+def peak_rss() -> int | None:
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def run(args:argparse.Namespace) -> dict:
+    sample = None
+    if args.sample:
+        with open(args.sample, 'rb') as f:
+            sample = f.read()
+    layout = CourseLayout(sections=args.sections, lessons=args.lessons, segments=args.segments,
+                          segment_size=args.segment_size * 1024, captions=tuple(filter(None, args.captions.split(','))),
+                          articles=args.articles, sample=sample)
+    cdn = FakeCdn(layout, latency=args.latency / 1000, bandwidth=args.bandwidth * 1024, error_rate=args.error_rate).start()
+
+    directory = tempfile.mkdtemp(prefix="udown-bench-")
+    cwd = os.getcwd()
+    try:
+        write_settings(directory, cdn.url, args)
+        os.chdir(directory)
+
+        from settings import SettingsManager, parse_cookies
+        from client import ApiClient
+        from api import fetch_purchased_courses
+        from objects import Course
+        from scheduler import CourseScheduler
+
+        # Without --mux lessons stop once their segments are on disk, the
+        # null packets served by default are not something ffmpeg can mux
+        class DownloadOnlyScheduler(CourseScheduler):
+            def merge(self, lesson, progress) -> None:
+                try:
+                    lesson.wait_captions()
+                    size = sum(os.path.getsize(lesson.segment_file(i)) for i in range(len(lesson.stream_segment_urls)))
+                finally:
+                    lesson.release_work_dir(self.settings, True)
+                with self._lock:
+                    self.downloaded += 1
+                    self.downloaded_bytes += size
+
+        settings = SettingsManager()
+        if not args.mux:
+            settings.download_mux_mode = "concat"
+        settings.api_client = ApiClient.from_cookies(parse_cookies(settings.cookies_file), settings.http, settings.xhr_headers)
+
+        started = time.monotonic()
+        result = fetch_purchased_courses(None, settings)[0]
+        course = Course(result['id'], settings, None, result['title'], result['url'])
+        course.fetch(None, settings)
+        scheduler = (CourseScheduler if args.mux else DownloadOnlyScheduler)(course, settings, None)
+        scheduler.run()
+        elapsed = time.monotonic() - started
+
+        report = settings.metrics.report(settings.cache.stats())
+        return {"lessons": args.lessons,
+                "articles": args.articles,
+                "segments": args.lessons * args.segments,
+                "segment_size": len(layout.segment),
+                "latency_ms": args.latency,
+                "bandwidth_kib": args.bandwidth,
+                "error_rate": args.error_rate,
+                "settings": args.set,
+                "mux": args.mux,
+                "elapsed": round(elapsed, 3),
+                "downloaded": scheduler.downloaded,
+                "failed": scheduler.failed,
+                "downloaded_bytes": scheduler.downloaded_bytes,
+                "segment_bytes": report['stages'].get('segment_fetch', {}).get('bytes', 0),
+                "throughput": round(report['stages'].get('segment_fetch', {}).get('bytes', 0) / elapsed) if elapsed else 0,
+                "peak_rss": peak_rss(),
+                "stages": report['stages']}
+    finally:
+        os.chdir(cwd)
+        cdn.stop()
+        if args.keep:
+            print(f"Kept {directory}", file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    RESULT = run(ARGS)
+    print(json.dumps(RESULT, indent=2))
+    if ARGS.output:
+        with open(ARGS.output, 'a') as f:
+            f.write(json.dumps(RESULT) + '\n')
@@ -0,0 +1,115 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "udown"))
+
+import pytest
+
+from hls import Variant, Segment, parse_master, parse_media, select_variant, coalesce_segments
+
+MASTER_URL = "https://cdn.example.com/hls/123/master.m3u8?token=abc"
+
+MASTER = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="English",LANGUAGE="en",DEFAULT=YES,URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="Spanish",LANGUAGE="es",URI="audio/es.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2",AUDIO="aud"
+360/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2800000,RESOLUTION=1280x720,FRAME-RATE=30,AUDIO="aud"
+/other/720/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1920x1080
+https://mirror.example.com/1080/index.m3u8
+"""
+
+
+def test_master_resolves_relative_uris():
+    master = parse_master(MASTER, MASTER_URL)
+    assert [x.url for x in master.variants] == ["https://cdn.example.com/hls/123/360/index.m3u8",
+                                                "https://cdn.example.com/other/720/index.m3u8",
+                                                "https://mirror.example.com/1080/index.m3u8"]
+    assert [x.height for x in master.variants] == [360, 720, 1080]
+    assert master.variants[1].frame_rate == 30.0
+
+
+def test_master_audio_rendition():
+    master = parse_master(MASTER, MASTER_URL)
+    audio = master.audio_rendition(master.variants[0])
+    assert audio.language == "en"
+    assert audio.url == "https://cdn.example.com/hls/123/audio/en.m3u8"
+    assert master.audio_rendition(master.variants[2]) is None
+
+
+def test_media_resolves_relative_uris():
+    text = "#EXTM3U\n#EXTINF:4.0,\nsegment0.ts\n#EXTINF:4.0,\n../shared/segment1.ts\n#EXT-X-ENDLIST\n"
+    media = parse_media(text, "https://cdn.example.com/hls/123/720/index.m3u8")
+    assert [x.url for x in media.segments] == ["https://cdn.example.com/hls/123/720/segment0.ts",
+                                               "https://cdn.example.com/hls/123/shared/segment1.ts"]
+    assert media.duration == 8.0
+
+
+def test_media_byterange_offsets():
+    text = """#EXTM3U
+#EXT-X-MEDIA-SEQUENCE:5
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@0
+video.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1500
+video.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:500@4000
+video.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:700
+video.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:300
+other.ts
+#EXT-X-ENDLIST
+"""
+    media = parse_media(text, "https://cdn.example.com/hls/123/720/index.m3u8")
+    # A range without an offset continues after the previous range of the same resource
+    assert [x.byterange for x in media.segments] == [(0, 1000), (1000, 1500), (4000, 500), (4500, 700), (0, 300)]
+    assert [x.sequence for x in media.segments] == [5, 6, 7, 8, 9]
+
+
+@pytest.mark.parametrize("preference, max_bandwidth, height", [
+    ("max", 0, 1080),
+    ("min", 0, 360),
+    ("720p", 0, 720),
+    (720, 0, 720),
+    ("480", 0, 360),
+    ("max", 3000000, 720),
+    ("1080", 1000000, 360),
+    # Nothing fits, the smallest variant is used
+    ("240", 0, 360),
+])
+def test_select_variant(preference, max_bandwidth, height):
+    master = parse_master(MASTER, MASTER_URL)
+    assert select_variant(master.variants, preference, max_bandwidth).height == height
+
+
+def test_select_variant_without_variants():
+    with pytest.raises(ValueError):
+        select_variant([])
+
+
+def test_select_variant_prefers_bandwidth_at_same_height():
+    variants = [Variant("a", 3000000, "1280x720"), Variant("b", 1500000, "1280x720")]
+    assert select_variant(variants, "max").url == "a"
+    assert select_variant(variants, "max", 2000000).url == "b"
+
+
+def test_coalesce_segments():
+    segments = [Segment("video.ts", 4.0, 0, (0, 1000)),
+                Segment("video.ts", 4.0, 1, (1000, 1000)),
+                Segment("video.ts", 4.0, 2, (2000, 1000)),
+                # Not back to back
+                Segment("video.ts", 4.0, 3, (5000, 1000)),
+                Segment("video.ts", 4.0, 4, (6000, 1000), discontinuity=True),
+                Segment("segment5.ts", 4.0, 5)]
+    coalesced = coalesce_segments(segments, 2500)
+    assert [(x.byterange, x.duration) for x in coalesced] == [((0, 2000), 8.0), ((2000, 1000), 4.0),
+                                                             ((5000, 1000), 4.0), ((6000, 1000), 4.0),
+                                                             (None, 4.0)]
+    assert coalesced[3].discontinuity
+    assert len(coalesce_segments(segments, 0)) == len(segments)
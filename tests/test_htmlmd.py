@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "udown"))
+
+import pytest
+
+from htmlmd import html_to_markdown
+
+
+@pytest.mark.parametrize("html, markdown", [
+    ("<p>Some <strong>bold</strong> and <em>emphasis</em>.</p>", "Some **bold** and *emphasis*.\n"),
+    ("<ul><li>a</li><li>b <a href=\"https://example.com\">link</a></li></ul>", "- a\n- b [link](https://example.com)\n"),
+    # Implicitly closed list items and table cells
+    ("<ul><li>a<li>b</ul><p>after</p>", "- a\n- b\n\nafter\n"),
+    ("<ol><li>one<ul><li>n1<li>n2</ul><li>two</ol>", "1. one\n   - n1\n   - n2\n2. two\n"),
+    ("<table><tr><th>A<th>B<tr><td>1<td>2</table>", "| A | B |\n|---|---|\n| 1 | 2 |\n"),
+    # Mis-nested and stray end tags
+    ("<p><strong><em>x</strong> y</em> z</p>", "***x*** y z\n"),
+    ("<p>stray</b> text</p>", "stray text\n"),
+    ("<ul><li>open", "- open\n"),
+])
+def test_html_to_markdown(html, markdown):
+    assert html_to_markdown(html) == markdown
+
+
+def test_image_location():
+    assert html_to_markdown("<img src=\"https://cdn/a.png\" alt=\"A\">", lambda src: "files/a.png") == "![A](files/a.png)\n"
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "udown"))
+
+from manifest import SegmentManifest
+
+STREAM_720 = "https://cdn.example.com/hls/1/720/index.m3u8?token=a"
+STREAM_1080 = "https://cdn.example.com/hls/1/1080/index.m3u8?token=a"
+
+
+def segment_urls(stream_url:str) -> list[str]:
+    base = stream_url.rsplit('/', 1)[0]
+    return [f"{base}/segment{i}.ts" for i in range(2)]
+
+
+def write_segments(work_dir:str, manifest:SegmentManifest) -> list[str]:
+    files = []
+    for i in range(len(manifest.segments)):
+        file_path = os.path.join(str(work_dir), f"segment_{i:05d}.ts")
+        with open(file_path, 'wb') as f:
+            f.write(b'\x47' * 188)
+        manifest.mark_completed(i, 188)
+        files.append(file_path)
+    manifest.save()
+    return files
+
+
+def test_resumes_same_stream(tmp_path):
+    manifest = SegmentManifest.load(str(tmp_path), STREAM_720, segment_urls(STREAM_720))
+    files = write_segments(tmp_path, manifest)
+
+    # Only the signing token changed
+    stream_url = STREAM_720.replace("token=a", "token=b")
+    resumed = SegmentManifest.load(str(tmp_path), stream_url, [x + "?token=b" for x in segment_urls(STREAM_720)])
+    assert [resumed.verify(i, x) for i, x in enumerate(files)] == [True, True]
+
+
+def test_discards_segments_of_another_stream(tmp_path):
+    manifest = SegmentManifest.load(str(tmp_path), STREAM_720, segment_urls(STREAM_720))
+    files = write_segments(tmp_path, manifest)
+    with open(files[0] + '.part', 'wb') as f:
+        f.write(b'\x47')
+
+    changed = SegmentManifest.load(str(tmp_path), STREAM_1080, segment_urls(STREAM_1080))
+    assert [changed.verify(i, x) for i, x in enumerate(files)] == [False, False]
+    assert changed.unverified(lambda i: files[i]) == [0, 1]
+    assert sorted(os.listdir(tmp_path)) == [SegmentManifest.file_name]
+
+
+def test_discards_segments_of_other_byteranges(tmp_path):
+    urls = segment_urls(STREAM_720)
+    manifest = SegmentManifest.load(str(tmp_path), STREAM_720, urls, [(0, 1000), (1000, 1000)])
+    files = write_segments(tmp_path, manifest)
+
+    # Same playlist coalesced with another coalesce_size
+    changed = SegmentManifest.load(str(tmp_path), STREAM_720, urls, [(0, 2000), (2000, 1000)])
+    assert [changed.verify(i, x) for i, x in enumerate(files)] == [False, False]
+
+
+def test_discards_segments_with_unreadable_manifest(tmp_path):
+    manifest = SegmentManifest.load(str(tmp_path), STREAM_720, segment_urls(STREAM_720))
+    files = write_segments(tmp_path, manifest)
+    with open(manifest.location, 'w') as f:
+        f.write("{")
+
+    reloaded = SegmentManifest.load(str(tmp_path), STREAM_720, segment_urls(STREAM_720))
+    assert [reloaded.verify(i, x) for i, x in enumerate(files)] == [False, False]
+    with open(reloaded.location, 'r') as f:
+        assert json.loads(f.read())['segments'][0]['completed'] is False
@@ -1,4 +1,4 @@
-from web import request_xhr
+from web import request_xhr, request_xhr_batch
 from settings import SettingsManager, CacheRole
 from utils import slugify
 
@@ -9,7 +9,7 @@ class ApiEndpointUrl(Enum):
     purchasedCourses = "https://www.udemy.com/api-2.0/users/me/subscribed-courses/?ordering=-last_accessed&fields%5Bcourse%5D=title,url&fields%5Buser%5D=@min,job_title&page=1&page_size=120&is_archived=false"
     courseContent = "https://www.udemy.com/api-2.0/courses/$course-id$/subscriber-curriculum-items/?page_size=1200&fields%5Blecture%5D=title,object_index,asset,supplementary_assets&fields%5Bquiz%5D=title,object_index,is_published,sort_order,type&fields%5Bpractice%5D=title,object_index,is_published,sort_order&fields%5Bchapter%5D=title,object_index,is_published,sort_order&fields%5Basset%5D=title,filename,asset_type,is_external&caching_intent=True"
     lessonContent = "https://www.udemy.com/api-2.0/users/me/subscribed-courses/$course-id$/lectures/$lesson-id$/?fields[lecture]=asset&fields[asset]=asset_type,media_sources,captions&q=0.03258319668748011"
-    lessonArticle = "https://www.udemy.com/api-2.0/assets/$asset-id$/?fields[asset]=@min,body&course_id=$course-id$&lecture_id=$lesson_id$"
+    lessonArticle = "https://www.udemy.com/api-2.0/assets/$asset-id$/?fields[asset]=@min,body&course_id=$course-id$&lecture_id=$lesson-id$"
 
 
 def fetch_purchased_courses(driver:webdriver, settings:SettingsManager) -> tuple[dict]:
@@ -21,7 +21,7 @@ def fetch_purchased_courses(driver:webdriver, settings:SettingsManager) -> tuple
 
     return data
 
-def fetch_article_body(asset_id:int, lesson_id:int,course_id:int,driver:webdriver, settings:SettingsManager) -> str:
+def article_url(asset_id:int, lesson_id:int, course_id:int) -> str:
     format_params = {
         '$course-id$':str(course_id),
         '$asset-id$': str(asset_id),
@@ -32,6 +32,11 @@ def fetch_article_body(asset_id:int, lesson_id:int,course_id:int,driver:webdrive
 
     for template, value in format_params.items():
         url = url.replace(template, value)
+    return url
+
+
+def fetch_article_body(asset_id:int, lesson_id:int,course_id:int,driver:webdriver, settings:SettingsManager) -> str:
+    url = article_url(asset_id, lesson_id, course_id)
     
     data = request_xhr(driver, url, settings, CacheRole.articleBody, str(course_id)+str(lesson_id))
     return data
@@ -48,7 +53,16 @@ def fetch_article_body(asset_id:int, lesson_id:int,course_id:int,driver:webdrive
     """
 
 
-def fetch_lesson_data(course_id:int, lesson_id:int, driver:webdriver, settings:SettingsManager) -> dict:
+def fetch_article_bodies(course_id:int, assets:dict[int, int], driver:webdriver, settings:SettingsManager, concurrency:int=8) -> dict[int, dict]:
+    # `assets` maps lesson ids to the asset ids of their articles
+    urls = {str(course_id)+str(lesson_id): article_url(asset_id, lesson_id, course_id) for lesson_id, asset_id in assets.items()}
+
+    data = request_xhr_batch(driver, urls, settings, CacheRole.articleBody, concurrency)
+
+    return {lesson_id: data[str(course_id)+str(lesson_id)] for lesson_id in assets if str(course_id)+str(lesson_id) in data}
+
+
+def lesson_content_url(course_id:int, lesson_id:int) -> str:
     format_params = {
         '$course-id$':str(course_id),
         '$lesson-id$': str(lesson_id)
@@ -58,11 +72,24 @@ def fetch_lesson_data(course_id:int, lesson_id:int, driver:webdriver, settings:S
 
     for template, value in format_params.items():
         url = url.replace(template, value)
+    return url
+
+
+def fetch_lesson_data(course_id:int, lesson_id:int, driver:webdriver, settings:SettingsManager) -> dict:
+    url = lesson_content_url(course_id, lesson_id)
 
     data = request_xhr(driver, url, settings, CacheRole.lessonStreams, str(course_id)+str(lesson_id))
 
     return data
 
+
+def fetch_lessons_data(course_id:int, lesson_ids:list[int], driver:webdriver, settings:SettingsManager, concurrency:int=8) -> dict[int, dict]:
+    urls = {str(course_id)+str(lesson_id): lesson_content_url(course_id, lesson_id) for lesson_id in lesson_ids}
+
+    data = request_xhr_batch(driver, urls, settings, CacheRole.lessonStreams, concurrency)
+
+    return {lesson_id: data[str(course_id)+str(lesson_id)] for lesson_id in lesson_ids if str(course_id)+str(lesson_id) in data}
+
     """
     {
     "_class": "lecture",
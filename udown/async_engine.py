@@ -0,0 +1,163 @@
+import asyncio
+import os
+import random
+import time
+import threading
+import concurrent.futures
+from loguru import logger
+
+from ratelimit import RateLimiter
+from metrics import Metrics
+from utils import SegmentError, TsVerifier, is_valid_ts, expected_size, range_header
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# Runs one event loop in a background thread that every lesson submits its
+# segments to. Submissions return concurrent futures, so callers can treat
+# the engine like the thread pool executor it replaces.
+class AsyncSegmentEngine():
+    def __init__(self, max_connections:int=200, per_host:int=50, timeout:tuple[float]=(10, 30), chunk_size:int=65536, limiter:RateLimiter=None, segment_retries:int=3, segment_backoff:float=1.0, verify:bool=True, metrics:Metrics=None) -> None:
+        if aiohttp is None:
+            raise ImportError("The asyncio download engine needs aiohttp, install it with `pip install aiohttp`")
+
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.limiter = limiter if limiter is not None and limiter.enabled else None
+        self.segment_retries = segment_retries
+        self.segment_backoff = segment_backoff
+        self.verify = verify
+        self.metrics = metrics
+
+        self._session = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="udown-async-engine", daemon=True)
+        self._thread.start()
+
+    async def _get_session(self) -> "aiohttp.ClientSession":
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            logger.debug(f"Opened async HTTP session ({self.max_connections} connections, {self.per_host} per host)")
+        return self._session
+
+    async def _request(self, link:str, headers:dict=None) -> "aiohttp.ClientResponse":
+        # Single attempt, _with_retries is the only retry layer like
+        # with_retries is for the thread engine
+        session = await self._get_session()
+        if self.limiter is not None:
+            await asyncio.sleep(self.limiter.request_delay(link))
+        return await session.get(link, headers=headers)
+
+    async def _download(self, link:str, file_path:str, byterange:tuple[int, int]=None) -> int:
+        if os.path.exists(file_path):
+            return os.path.getsize(file_path)
+
+        part_name = file_path+'.part'
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+
+        response = await self._request(link, range_header(byterange, offset))
+        async with response:
+            if offset and response.status == 416:
+                os.remove(part_name)
+                return await self._download(link, file_path, byterange)
+            response.raise_for_status()
+            if byterange is not None:
+                if response.status != 206:
+                    raise SegmentError(f"Server ignored the byte range for {link}")
+                size = byterange[1]
+            else:
+                if response.status != 206:
+                    offset = 0
+                size = expected_size(response.status, response.headers)
+
+            # Disk writes go to the default executor, a slow write on the
+            # loop thread would stall every other request in flight
+            loop = asyncio.get_running_loop()
+            verifier = TsVerifier() if self.verify else None
+            if verifier is not None and offset:
+                await loop.run_in_executor(None, verifier.update_from_file, part_name, self.chunk_size)
+
+            f = await loop.run_in_executor(None, open, part_name, 'ab' if offset else 'wb')
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await loop.run_in_executor(None, f.write, chunk)
+                    if verifier is not None:
+                        verifier.update(chunk)
+                    if self.limiter is not None:
+                        await asyncio.sleep(self.limiter.bytes_delay(len(chunk)))
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+        written = os.path.getsize(part_name)
+        if size is not None and written != size:
+            if written > size:
+                os.remove(part_name)
+            raise SegmentError(f"Segment {link} is {written} bytes, expected {size}")
+        if verifier is not None and not verifier.complete():
+            os.remove(part_name)
+            raise SegmentError(f"Segment {link} is not a valid transport stream")
+        os.replace(part_name, file_path)
+        return os.path.getsize(file_path)
+
+    async def _fetch(self, link:str, byterange:tuple[int, int]=None) -> bytes:
+        response = await self._request(link, range_header(byterange))
+        async with response:
+            response.raise_for_status()
+            if byterange is not None and response.status != 206:
+                raise SegmentError(f"Server ignored the byte range for {link}")
+            size = byterange[1] if byterange is not None else expected_size(response.status, response.headers)
+            content = await response.read()
+        if self.limiter is not None:
+            await asyncio.sleep(self.limiter.bytes_delay(len(content)))
+        if size is not None and len(content) != size:
+            raise SegmentError(f"Segment {link} is {len(content)} bytes, expected {size}")
+        if self.verify and not is_valid_ts(content):
+            raise SegmentError(f"Segment {link} is not a valid transport stream")
+        return content
+
+    async def _with_retries(self, function, *args):
+        for attempt in range(self.segment_retries + 1):
+            started = time.monotonic()
+            try:
+                result = await function(*args)
+            except (aiohttp.ClientError, asyncio.TimeoutError, SegmentError) as e:
+                if self.metrics is not None:
+                    self.metrics.record("segment_fetch", time.monotonic() - started, failed=True)
+                # Same rule as utils.with_retries, client errors do not go away by asking again
+                status = getattr(e, 'status', None)
+                if attempt == self.segment_retries or (status is not None and 400 <= status < 500 and status not in (408, 429)):
+                    raise
+                delay = self.segment_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After', "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                logger.warning(f"{e}, retrying in {delay:.1f}s ({attempt + 1}/{self.segment_retries})")
+                if self.metrics is not None:
+                    self.metrics.retry("segment_fetch")
+                await asyncio.sleep(delay)
+            else:
+                if self.metrics is not None:
+                    self.metrics.record("segment_fetch", time.monotonic() - started, len(result) if isinstance(result, bytes) else result)
+                return result
+
+    def download(self, link:str, file_path:str, byterange:tuple[int, int]=None) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self._with_retries(self._download, link, file_path, byterange), self._loop)
+
+    def fetch(self, link:str, byterange:tuple[int, int]=None) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self._with_retries(self._fetch, link, byterange), self._loop)
+
+    def close(self) -> None:
+        if not self._loop.is_running():
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
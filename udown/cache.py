@@ -0,0 +1,324 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from loguru import logger
+
+
+def is_fresh(stored_at:float, max_age:int=None) -> bool:
+    return not max_age or time.time() - stored_at <= max_age
+
+
+class MemoryCache():
+    def __init__(self, max_entries:int=1024) -> None:
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+
+        self._entries:OrderedDict[tuple[str, str], tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, role:str, id:str, max_age:int=None) -> tuple[dict, float] | None:
+        key = (role, str(id))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not is_fresh(entry[1], max_age):
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses[role] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[role] += 1
+            return entry
+
+    def put(self, role:str, id:str, content:dict, stored_at:float=None) -> None:
+        if not self.max_entries:
+            return
+        key = (role, str(id))
+        with self._lock:
+            self._entries[key] = (content, time.time() if stored_at is None else stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, role:str, id:str) -> None:
+        with self._lock:
+            self._entries.pop((role, str(id)), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class CacheBackend():
+    # Returns (content, stored_at) for every id that is present and fresh
+    def read_entries(self, role:str, ids:list[str], max_age:int=None) -> dict[str, tuple[dict, float]]:
+        raise NotImplementedError
+
+    def write(self, role:str, id:str, content:dict) -> None:
+        raise NotImplementedError
+
+    def write_many(self, role:str, items:dict[str, dict]) -> None:
+        for id, content in items.items():
+            self.write(role, id, content)
+
+    def delete(self, role:str, id:str) -> bool:
+        raise NotImplementedError
+
+    # Drops entries older than their role's expiry, then the least recently
+    # used ones until the store is below max_size bytes (0 means no cap).
+    def evict(self, max_size:int, expires:dict[str, int]) -> int:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def compact(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class JsonFileBackend(CacheBackend):
+    def __init__(self, directory:str) -> None:
+        self.directory = directory
+
+    def location(self, role:str, id:str) -> str:
+        return os.path.join(self.directory, role, str(id))+'.json'
+
+    def read_entries(self, role:str, ids:list[str], max_age:int=None) -> dict[str, tuple[dict, float]]:
+        found = {}
+        for id in map(str, ids):
+            location = self.location(role, id)
+            try:
+                # The modification time is when the entry was stored
+                stored_at = os.path.getmtime(location)
+                if not is_fresh(stored_at, max_age):
+                    continue
+                with open(location, 'r') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                continue
+
+            # The access time tracks recency for eviction
+            try:
+                os.utime(location, (time.time(), stored_at))
+            except OSError:
+                pass
+
+            try:
+                found[id] = (json.loads(content), stored_at)
+            except json.decoder.JSONDecodeError:
+                logger.warning(f"Could not parse cache file {location}")
+        return found
+
+    def write(self, role:str, id:str, content:dict) -> None:
+        location = self.location(role, id)
+        with open(location+'.tmp', 'w') as f:
+            f.write(json.dumps(content))
+        os.replace(location+'.tmp', location)
+
+    def delete(self, role:str, id:str) -> bool:
+        try:
+            os.remove(self.location(role, id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def evict(self, max_size:int, expires:dict[str, int]) -> int:
+        entries = []
+        removed = 0
+        for role in os.listdir(self.directory):
+            role_dir = os.path.join(self.directory, role)
+            if not os.path.isdir(role_dir):
+                continue
+            for file_name in os.listdir(role_dir):
+                if not file_name.endswith('.json'):
+                    continue
+                location = os.path.join(role_dir, file_name)
+                try:
+                    stat = os.stat(location)
+                    if not is_fresh(stat.st_mtime, expires.get(role)):
+                        os.remove(location)
+                        removed += 1
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, location))
+
+        total = sum(size for _, size, _ in entries)
+        if max_size:
+            for _, size, location in sorted(entries):
+                if total <= max_size:
+                    break
+                try:
+                    os.remove(location)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+        return removed
+
+
+class SqliteBackend(CacheBackend):
+    file_name = "cache.sqlite3"
+
+    def __init__(self, directory:str, batch_size:int=50, compact_threshold:int=500) -> None:
+        self.directory = directory
+        self.location = os.path.join(directory, self.file_name)
+        self.batch_size = batch_size
+        self.compact_threshold = compact_threshold
+
+        # Writes are buffered and committed in batches, reads see them first
+        self._pending:dict[tuple[str, str], tuple[str, float]] = {}
+        self._touched:dict[tuple[str, str], float] = {}
+        self._deleted = 0
+        self._lock = threading.RLock()
+
+        is_new = not os.path.exists(self.location)
+        self._connection = sqlite3.connect(self.location, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                        role TEXT NOT NULL,
+                                        id TEXT NOT NULL,
+                                        content TEXT NOT NULL,
+                                        stored_at REAL NOT NULL,
+                                        accessed_at REAL NOT NULL DEFAULT 0,
+                                        PRIMARY KEY (role, id)
+                                    ) WITHOUT ROWID""")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(cache)")]
+        if 'accessed_at' not in columns:
+            self._connection.execute("ALTER TABLE cache ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+
+        if is_new:
+            self.import_json_files()
+
+    def import_json_files(self) -> None:
+        imported = 0
+        for role in os.listdir(self.directory):
+            role_dir = os.path.join(self.directory, role)
+            if not os.path.isdir(role_dir):
+                continue
+            for file_name in os.listdir(role_dir):
+                if not file_name.endswith('.json'):
+                    continue
+                location = os.path.join(role_dir, file_name)
+                try:
+                    with open(location, 'r') as f:
+                        content = f.read()
+                    json.loads(content)
+                except (IOError, json.decoder.JSONDecodeError):
+                    continue
+                self._pending[(role, file_name[:-len('.json')])] = (content, os.path.getmtime(location))
+                imported += 1
+        if imported:
+            self.flush()
+            logger.info(f"Imported {imported} json cache files into {self.location}")
+
+    def read_entries(self, role:str, ids:list[str], max_age:int=None) -> dict[str, tuple[dict, float]]:
+        ids = [str(id) for id in ids]
+        oldest = time.time() - max_age if max_age else 0
+        found = {}
+        with self._lock:
+            missing = []
+            for id in ids:
+                if (role, id) in self._pending:
+                    content, stored_at = self._pending[(role, id)]
+                    if stored_at >= oldest:
+                        found[id] = (json.loads(content), stored_at)
+                else:
+                    missing.append(id)
+
+            # Stay below sqlite's bound parameter limit
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start+500]
+                rows = self._connection.execute(
+                    f"SELECT id, content, stored_at FROM cache WHERE role = ? AND stored_at >= ? AND id IN ({','.join('?' * len(chunk))})",
+                    (role, oldest, *chunk)).fetchall()
+                for id, content, stored_at in rows:
+                    found[id] = (json.loads(content), stored_at)
+
+            # Access times are written along with the next batch
+            now = time.time()
+            for id in found:
+                self._touched[(role, id)] = now
+        return found
+
+    def write(self, role:str, id:str, content:dict) -> None:
+        self.write_many(role, {id: content})
+
+    def write_many(self, role:str, items:dict[str, dict]) -> None:
+        now = time.time()
+        with self._lock:
+            for id, content in items.items():
+                self._pending[(role, str(id))] = (json.dumps(content), now)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._pending and not self._touched:
+                return
+            rows = [(role, id, content, stored_at, stored_at) for (role, id), (content, stored_at) in self._pending.items()]
+            touched = [(accessed_at, role, id) for (role, id), accessed_at in self._touched.items()]
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR REPLACE INTO cache (role, id, content, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)", rows)
+            self._connection.executemany("UPDATE cache SET accessed_at = ? WHERE role = ? AND id = ?", touched)
+            self._connection.execute("COMMIT")
+            self._pending.clear()
+            self._touched.clear()
+            if rows:
+                logger.debug(f"Committed {len(rows)} cache entries")
+
+    def delete(self, role:str, id:str) -> bool:
+        with self._lock:
+            pending = self._pending.pop((role, str(id)), None) is not None
+            deleted = self._connection.execute("DELETE FROM cache WHERE role = ? AND id = ?", (role, str(id))).rowcount > 0
+            if deleted:
+                self._deleted += 1
+        return pending or deleted
+
+    def evict(self, max_size:int, expires:dict[str, int]) -> int:
+        removed = 0
+        now = time.time()
+        with self._lock:
+            self.flush()
+            self._connection.execute("BEGIN")
+            for role, expire in expires.items():
+                if expire:
+                    removed += self._connection.execute("DELETE FROM cache WHERE role = ? AND stored_at < ?", (role, now - expire)).rowcount
+
+            if max_size:
+                total = self._connection.execute("SELECT COALESCE(SUM(LENGTH(content)), 0) FROM cache").fetchone()[0]
+                victims = []
+                if total > max_size:
+                    for role, id, size in self._connection.execute("SELECT role, id, LENGTH(content) FROM cache ORDER BY accessed_at ASC").fetchall():
+                        if total <= max_size:
+                            break
+                        victims.append((role, id))
+                        total -= size
+                self._connection.executemany("DELETE FROM cache WHERE role = ? AND id = ?", victims)
+                removed += len(victims)
+            self._connection.execute("COMMIT")
+            self._deleted += removed
+        return removed
+
+    def compact(self) -> None:
+        with self._lock:
+            self.flush()
+            self._connection.execute("VACUUM")
+            self._deleted = 0
+        logger.debug(f"Compacted {self.location}")
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            if self._deleted >= self.compact_threshold:
+                self.compact()
+            self._connection.close()
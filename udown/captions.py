@@ -0,0 +1,58 @@
+import os
+import threading
+import concurrent.futures
+from loguru import logger
+
+from transport import SessionPool
+from metrics import Metrics
+
+
+# Caption files are stored once under their caption id and file name and
+# reused by every lesson and every later run that asks for the same caption.
+# Concurrent requests for one caption share a single download.
+class CaptionCache():
+    def __init__(self, directory:str, http:SessionPool, metrics:Metrics=None) -> None:
+        self.directory = directory
+        self.http = http
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._futures:dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def location(self, caption:dict) -> str:
+        file_name = os.path.basename(caption.get('file_name') or f"{caption.get('locale_id', 'caption')}.vtt")
+        return os.path.join(self.directory, f"{caption['id']}_{file_name}")
+
+    def download(self, caption:dict) -> str:
+        location = self.location(caption)
+        if os.path.exists(location):
+            logger.debug(f"Using cached {caption.get('video_label', caption['id'])} captions")
+            return location
+
+        with self.metrics.stage("caption_fetch") as timer:
+            response = self.http.get(caption['url'])
+            response.raise_for_status()
+            timer.bytes = len(response.content)
+        with open(location+'.part', 'wb') as f:
+            f.write(response.content)
+        os.replace(location+'.part', location)
+        logger.debug(f"Downloaded {caption.get('video_label', caption['id'])} captions")
+        return location
+
+    def fetch(self, caption:dict, executor:concurrent.futures.Executor) -> concurrent.futures.Future:
+        key = self.location(caption)
+        with self._lock:
+            future = self._futures.get(key)
+            # Failed downloads are tried again by the next lesson asking
+            if future is None or (future.done() and future.exception() is not None):
+                future = executor.submit(self.download, caption)
+                self._futures[key] = future
+        return future
+
+
+def filter_captions(captions:list[dict], locales:list[str]) -> list[dict]:
+    # `en` keeps every English caption, `en_US` only that one
+    if not locales:
+        return list(captions)
+    return [caption for caption in captions
+            if caption.get('locale_id') in locales or caption.get('locale_id', "").split('_')[0] in locales]
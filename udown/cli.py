@@ -1,61 +1,148 @@
+import argparse
+import os
 import undetected_chromedriver as webdriver
 from loguru import logger
 
-from utils import slugify
-from settings import SettingsManager, parse_cookies
+from settings import SettingsManager, parse_cookies, email_from_cookies
 from objects import Course
-from web import setup_selenium, authenticate_user
+from scheduler import CourseScheduler, BatchScheduler, SyncScheduler
+from jobqueue import JobQueue, JobState
+from snapshot import CurriculumSnapshot
+from web import LazyDriver
 from api import fetch_purchased_courses
+from client import ApiClient
 
 
-if __name__ == '__main__':
-    SETTINGS = SettingsManager()
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Without arguments the purchased courses are listed and one of them is picked interactively.")
+    parser.add_argument('courses', nargs='*', help="course ids or slugs to queue for a batch run, or `all` for every purchased course")
+    parser.add_argument('--resume', action='store_true', help="process the courses left in the job queue without adding any")
+    parser.add_argument('--workers', type=int, default=None, help="lessons downloaded in parallel, defaults to downloads.parallel_lessons")
+    parser.add_argument('--queue', default=None, help="job queue file, defaults to batch.queue_file")
+    parser.add_argument('--sync', action='store_true', help="only download what changed in the given courses since their last sync")
+    return parser.parse_args()
 
-    driver:webdriver = setup_selenium(SETTINGS.selenium.webdriver_path, SETTINGS.selenium.browser_path)
-    logger.debug("Created driver instance")
 
-    if SETTINGS.auth == 'password':
-        SETTINGS.credentials.load(SETTINGS.credentials_file)            
-        authenticate_user(driver, SETTINGS.credentials.email, SETTINGS.credentials.password)
+def select_courses(requested:list[str], purchased:tuple[dict]) -> list[dict]:
+    by_id = {str(result['id']): result for result in purchased}
+    by_slug = {result['url'].split("/course/")[-1].strip("/"): result for result in purchased}
 
-    elif SETTINGS.auth == 'cookies':
-        cookies: tuple[dict] = parse_cookies(SETTINGS.cookies_file)
+    if 'all' in requested:
+        requested = list(by_id)
+
+    selected = []
+    for key in requested:
+        result = by_id.get(key) or by_slug.get(key.strip("/"))
+        if result is None:
+            logger.error(f"{key} is not one of the purchased courses")
+            continue
+        selected.append(result)
+    return selected
+
+
+def queue_courses(queue:JobQueue, requested:list[str], purchased:tuple[dict]) -> None:
+    for result in select_courses(requested, purchased):
+        if queue.add_course(result['id'], result['title'], result['url']):
+            logger.info(f"Queued {result['title']} ({result['id']})")
+        elif queue.course_state(result['id']) == JobState.DONE:
+            # Asking for a finished course again picks up lectures added since
+            queue.set_course_state(result['id'], JobState.PENDING)
+            logger.info(f"Requeued {result['title']} ({result['id']}), it was already done. Lessons the queue has as done are not downloaded again")
+        else:
+            logger.info(f"{result['title']} ({result['id']}) is already queued")
+
+
+def run_batch(args:argparse.Namespace, settings:SettingsManager, driver:webdriver) -> None:
+    queue = JobQueue(args.queue or settings.batch_queue_file)
+
+    if args.courses:
+        queue_courses(queue, args.courses, fetch_purchased_courses(driver, settings))
+
+    courses = []
+    for job in queue.pending_courses():
+        course = Course(job['id'], settings, driver, job['title'], job['url'])
+        course.fetch(driver, settings)
+        if getattr(course, 'content', None) is None:
+            queue.set_course_state(course.id, JobState.FAILED)
+            continue
+        queue.sync_lessons(course.id, [lesson for section in course.content for lesson in section['lessons']])
+        queue.set_course_state(course.id, JobState.RUNNING)
+        courses.append(course)
+
+    if not courses:
+        logger.info("Job queue is empty")
+        return
+    BatchScheduler(courses, settings, driver, queue, args.workers).run()
+
+
+def sync_course(result:dict, args:argparse.Namespace, settings:SettingsManager, driver:webdriver) -> None:
+    course = Course(result['id'], settings, driver, result['title'], result['url'])
+    course.fetch(driver, settings, refresh=True, prefetch=False)
+    if getattr(course, 'content', None) is None:
+        return
+
+    snapshot = CurriculumSnapshot(os.path.join(settings.sync_directory, f"{course.id}.json"))
+    lessons = snapshot.apply(course, [lesson for section in course.content for lesson in section['lessons']], settings)
+
+    # Renames are applied by now, so only the lessons left to download are prefetched
+    if lessons and settings.download_prefetch:
+        course.prefetch(driver, settings)
+    SyncScheduler(course, settings, driver, snapshot, lessons, args.workers).run()
 
-        for cookie in cookies:
-            if cookie['name'] == "ud_last_auth_information":
-                SETTINGS.credentials.email = slugify(cookie['value']).split("-user-email-")[-1].split('-suggested-')[0]
-
-        driver.get("https://udemy.com")
-
-        for cookie in cookies:
-            if 'sameSite' in cookie:
-                if cookie['sameSite'] in ('strict', 'lax'):
-                    cookie['sameSite'] = cookie['sameSite'].title()
-                else:
-                    cookie['sameSite'] = 'None'
-            driver.add_cookie(cookie)
-        driver.refresh()
-        logger.debug("Loaded cookies")
-    
+
+def run_sync(args:argparse.Namespace, settings:SettingsManager, driver:webdriver) -> None:
+    if not args.courses:
+        logger.error("Pass the course ids or slugs to sync, or `all`")
+        return
+
+    for result in select_courses(args.courses, fetch_purchased_courses(driver, settings)):
+        sync_course(result, args, settings, driver)
+
+
+def run_interactive(settings:SettingsManager, driver:webdriver) -> None:
     # LIST PURCHASED COURSES
-    
-    purchased_courses_response:tuple[dict] = fetch_purchased_courses(driver, SETTINGS)
+
+    purchased_courses_response:tuple[dict] = fetch_purchased_courses(driver, settings)
 
     purchased_courses:list[Course] = []
     for menu_index, result in enumerate(purchased_courses_response):
         course_title:str = result['title']
-        purchased_courses.append(Course(result['id'], SETTINGS, driver, course_title, result['url']))
+        purchased_courses.append(Course(result['id'], settings, driver, course_title, result['url']))
 
         print(f"{menu_index} - {course_title}")
-    
+
     selected_index = int(input("Select Course: "))
 
     selected_course: Course = purchased_courses[selected_index]
-    selected_course.fetch(driver, SETTINGS)
+    selected_course.fetch(driver, settings)
+
+    CourseScheduler(selected_course, settings, driver).run()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    SETTINGS = SettingsManager()
+
+    # The browser is only started on the first request the cache cannot answer
+    driver:webdriver = LazyDriver(SETTINGS)
+
+    if SETTINGS.auth == 'password':
+        SETTINGS.credentials.load(SETTINGS.credentials_file)
+
+    elif SETTINGS.auth == 'cookies':
+        cookies: tuple[dict] = parse_cookies(SETTINGS.cookies_file)
+        SETTINGS.credentials.email = email_from_cookies(cookies) or SETTINGS.credentials.email
 
-    for section in selected_course.content:
-        logger.info(f"Downloading section {section}")
+    if SETTINGS.api_transport == "http":
+        if SETTINGS.auth == 'cookies':
+            # Cookie sessions can go straight to the api without any browser
+            SETTINGS.api_client = ApiClient.from_cookies(cookies, SETTINGS.http, SETTINGS.xhr_headers, SETTINGS.api_user_agent)
+        else:
+            SETTINGS.api_client = ApiClient.from_driver(driver, SETTINGS.http, SETTINGS.xhr_headers)
 
-        for lesson in section['lessons']:
-            lesson.download(SETTINGS, driver)
-    
+    if ARGS.sync:
+        run_sync(ARGS, SETTINGS, driver)
+    elif ARGS.courses or ARGS.resume:
+        run_batch(ARGS, SETTINGS, driver)
+    else:
+        run_interactive(SETTINGS, driver)
@@ -0,0 +1,90 @@
+import json
+import time
+import concurrent.futures
+import requests
+import undetected_chromedriver as webdriver
+from loguru import logger
+
+from transport import SessionPool
+
+
+def parse_xhr_headers(xhr_headers:str) -> dict[str, str]:
+    # headers.txt holds the `"headers": {...}` fragment of a fetch() call
+    try:
+        headers = json.loads('{' + xhr_headers + '}')['headers']
+    except (json.decoder.JSONDecodeError, KeyError, TypeError):
+        logger.error("XHR headers file could not be parsed")
+        quit()
+    return {key: value for key, value in headers.items() if value}
+
+
+# Talks to the api directly with the session the browser logged in with
+class ApiClient():
+    origin = "https://www.udemy.com"
+
+    def __init__(self, http:SessionPool, headers:dict[str, str], cookies:list[dict]) -> None:
+        self.http = http
+        self.headers = dict(headers)
+        self.headers.setdefault('referer', self.origin + "/")
+
+        self.cookies = requests.cookies.RequestsCookieJar()
+        for cookie in cookies:
+            self.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ""), path=cookie.get('path', "/"))
+            if cookie['name'] == 'access_token':
+                self.headers.setdefault('authorization', f"Bearer {cookie['value']}")
+                self.headers.setdefault('x-udemy-authorization', f"Bearer {cookie['value']}")
+
+    @classmethod
+    def from_cookies(cls, cookies:tuple[dict], http:SessionPool, xhr_headers:str, user_agent:str=None) -> "ApiClient":
+        headers = parse_xhr_headers(xhr_headers)
+        if user_agent:
+            headers['user-agent'] = user_agent
+        client = cls(http, headers, cookies)
+        logger.debug(f"Loaded {len(client.cookies)} cookies into the http api client")
+        return client
+
+    @classmethod
+    def from_driver(cls, driver:webdriver, http:SessionPool, xhr_headers:str, timeout:float=30) -> "ApiClient":
+        # A password login is still redirecting when the submit click returns,
+        # the session only exists once the access_token cookie has been set
+        deadline = time.monotonic() + timeout
+        while driver.get_cookie('access_token') is None:
+            if time.monotonic() > deadline:
+                logger.error(f"Browser has no access_token cookie after {timeout:.0f}s, the login did not complete.")
+                quit()
+            time.sleep(0.2)
+
+        headers = parse_xhr_headers(xhr_headers)
+        # Cookies such as cf_clearance are bound to the browser's user agent
+        headers['user-agent'] = driver.execute_script("return navigator.userAgent")
+        client = cls(http, headers, driver.get_cookies())
+        logger.debug(f"Moved browser session with {len(client.cookies)} cookies to the http api client")
+        return client
+
+    def get_json(self, url:str) -> dict | None:
+        try:
+            response = self.http.get(url, headers=self.headers, cookies=self.cookies)
+        except requests.RequestException as e:
+            logger.error(f"Request to {url} failed: {e}")
+            return None
+
+        if response.status_code in (401, 403):
+            logger.error(f"Api refused the request with {response.status_code}, the session may have expired.")
+            return None
+        if not response.ok:
+            logger.error(f"Api responded with {response.status_code} for {url}")
+            return None
+
+        try:
+            return response.json()
+        except ValueError:
+            logger.error(f"Api response for {url} is not json")
+            return None
+
+    def get_json_many(self, urls:dict[str, str], concurrency:int=8) -> dict[str, dict]:
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            future_to_id = {executor.submit(self.get_json, url): id for id, url in urls.items()}
+            for future in concurrent.futures.as_completed(future_to_id):
+                results[future_to_id[future]] = future.result()
+        return results
@@ -0,0 +1,89 @@
+import statistics
+import threading
+import time
+from loguru import logger
+
+
+# Gates how many segment requests are in flight and tunes that number
+# AIMD style: add one while throughput keeps improving, halve it on errors
+# or when latency grows without any throughput to show for it, and hold
+# once more requests stop paying off.
+class AdaptiveLimiter():
+    def __init__(self, minimum:int=1, maximum:int=16, initial:int=None, interval:float=2.0, gain:float=0.05, latency_tolerance:float=2.0) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial or self.minimum))
+        self.interval = interval
+        self.gain = gain
+        self.latency_tolerance = latency_tolerance
+
+        self.peak = self.limit
+        self.adjustments = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_latencies = []
+        self._last_throughput = 0.0
+        self._base_latency = None
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, size:int, latency:float, failed:bool=False) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            if failed:
+                self._window_errors += 1
+            else:
+                self._window_bytes += size
+                self._window_latencies.append(latency)
+            self._adjust()
+            self._condition.notify_all()
+
+    def call(self, function, *args, **kwargs):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException:
+            self.release(0, time.monotonic() - start, failed=True)
+            raise
+        self.release(len(result) if isinstance(result, bytes) else result, time.monotonic() - start)
+        return result
+
+    def _adjust(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval or not (self._window_latencies or self._window_errors):
+            return
+
+        throughput = self._window_bytes / elapsed
+        latency = statistics.median(self._window_latencies) if self._window_latencies else None
+        if latency is not None and (self._base_latency is None or latency < self._base_latency):
+            self._base_latency = latency
+
+        limit = self.limit
+        if self._window_errors:
+            limit = max(self.minimum, self.limit // 2)
+        elif throughput > self._last_throughput * (1 + self.gain):
+            limit = min(self.maximum, self.limit + 1)
+        elif latency is not None and latency > self._base_latency * self.latency_tolerance:
+            limit = max(self.minimum, self.limit // 2)
+
+        if limit != self.limit:
+            logger.debug(f"Segment concurrency {self.limit} -> {limit} ({throughput / 1024:.0f} KiB/s, {self._window_errors} errors)")
+            self.limit = limit
+            self.peak = max(self.peak, limit)
+            self.adjustments += 1
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_latencies = []
@@ -0,0 +1,229 @@
+import re
+from urllib.parse import urljoin
+from loguru import logger
+
+from transport import SessionPool
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attributes(text:str) -> dict[str, str]:
+    return {key: value.strip('"') for key, value in ATTRIBUTE_PATTERN.findall(text)}
+
+
+class Variant():
+    def __init__(self, url:str, bandwidth:int=0, resolution:str=None, frame_rate:float=None, codecs:str=None, audio:str=None) -> None:
+        self.url = url
+        self.bandwidth = bandwidth
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.codecs = codecs
+        self.audio = audio
+
+    @property
+    def height(self) -> int:
+        if not self.resolution or 'x' not in self.resolution:
+            return 0
+        return int(self.resolution.split('x')[1])
+
+    def __repr__(self) -> str:
+        return f"Variant({self.resolution or '?'}, {self.bandwidth} bps)"
+
+
+class Rendition():
+    def __init__(self, type:str, group_id:str, name:str=None, language:str=None, default:bool=False, url:str=None) -> None:
+        self.type = type
+        self.group_id = group_id
+        self.name = name
+        self.language = language
+        self.default = default
+        # Renditions without a uri are muxed into the variant stream
+        self.url = url
+
+
+class Segment():
+    def __init__(self, url:str, duration:float, sequence:int, byterange:tuple[int, int]=None, discontinuity:bool=False) -> None:
+        self.url = url
+        self.duration = duration
+        self.sequence = sequence
+        # (offset, length) within the resource at url
+        self.byterange = byterange
+        self.discontinuity = discontinuity
+
+
+class MasterPlaylist():
+    def __init__(self, url:str, variants:list[Variant], renditions:list[Rendition]) -> None:
+        self.url = url
+        self.variants = variants
+        self.renditions = renditions
+
+    def audio_rendition(self, variant:Variant) -> Rendition | None:
+        # Only a rendition with its own playlist needs to be fetched separately
+        group = [x for x in self.renditions if x.type == 'AUDIO' and x.group_id == variant.audio and x.url]
+        if not group:
+            return None
+        return next((x for x in group if x.default), group[0])
+
+
+class MediaPlaylist():
+    def __init__(self, url:str, segments:list[Segment], target_duration:float=None, encryption:str=None, init_url:str=None) -> None:
+        self.url = url
+        self.segments = segments
+        self.target_duration = target_duration
+        self.encryption = encryption
+        self.init_url = init_url
+
+    @property
+    def duration(self) -> float:
+        return sum(segment.duration for segment in self.segments)
+
+
+def _lines(text:str) -> list[str]:
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def is_master(text:str) -> bool:
+    return '#EXT-X-STREAM-INF' in text
+
+
+def parse_master(text:str, url:str) -> MasterPlaylist:
+    variants = []
+    renditions = []
+    stream_info = None
+    for line in _lines(text):
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            stream_info = parse_attributes(line[len('#EXT-X-STREAM-INF:'):])
+        elif line.startswith('#EXT-X-MEDIA:'):
+            attributes = parse_attributes(line[len('#EXT-X-MEDIA:'):])
+            renditions.append(Rendition(type=attributes.get('TYPE'),
+                                        group_id=attributes.get('GROUP-ID'),
+                                        name=attributes.get('NAME'),
+                                        language=attributes.get('LANGUAGE'),
+                                        default=attributes.get('DEFAULT') == 'YES',
+                                        url=urljoin(url, attributes['URI']) if 'URI' in attributes else None))
+        elif not line.startswith('#') and stream_info is not None:
+            variants.append(Variant(url=urljoin(url, line),
+                                    bandwidth=int(stream_info.get('BANDWIDTH', 0)),
+                                    resolution=stream_info.get('RESOLUTION'),
+                                    frame_rate=float(stream_info['FRAME-RATE']) if 'FRAME-RATE' in stream_info else None,
+                                    codecs=stream_info.get('CODECS'),
+                                    audio=stream_info.get('AUDIO')))
+            stream_info = None
+    return MasterPlaylist(url, variants, renditions)
+
+
+def parse_media(text:str, url:str) -> MediaPlaylist:
+    segments = []
+    sequence = 0
+    duration = 0.0
+    byterange = None
+    discontinuity = False
+    target_duration = None
+    encryption = None
+    init_url = None
+    # A byte range without an offset continues where the previous one of the same resource ended
+    next_offset:dict[str, int] = {}
+
+    for line in _lines(text):
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line.split(':', 1)[1].partition('@')
+            byterange = (int(offset) if offset else None, int(length))
+        elif line.startswith('#EXT-X-DISCONTINUITY') and not line.startswith('#EXT-X-DISCONTINUITY-SEQUENCE'):
+            discontinuity = True
+        elif line.startswith('#EXT-X-KEY:'):
+            method = parse_attributes(line[len('#EXT-X-KEY:'):]).get('METHOD', 'NONE')
+            encryption = None if method == 'NONE' else method
+        elif line.startswith('#EXT-X-MAP:'):
+            attributes = parse_attributes(line[len('#EXT-X-MAP:'):])
+            if 'URI' in attributes:
+                init_url = urljoin(url, attributes['URI'])
+        elif not line.startswith('#'):
+            segment_url = urljoin(url, line)
+            if byterange is not None:
+                offset, length = byterange
+                if offset is None:
+                    offset = next_offset.get(segment_url, 0)
+                byterange = (offset, length)
+                next_offset[segment_url] = offset + length
+            segments.append(Segment(segment_url, duration, sequence, byterange, discontinuity))
+            sequence += 1
+            duration = 0.0
+            byterange = None
+            discontinuity = False
+    return MediaPlaylist(url, segments, target_duration, encryption, init_url)
+
+
+# Merges runs of byte range segments that are back to back in the same
+# resource into single requests of up to max_size bytes. Segments without a
+# byte range and discontinuities always start a new request.
+def coalesce_segments(segments:list[Segment], max_size:int) -> list[Segment]:
+    if not max_size:
+        return list(segments)
+
+    coalesced = []
+    for segment in segments:
+        previous = coalesced[-1] if coalesced else None
+        if previous is not None \
+           and segment.byterange is not None and previous.byterange is not None \
+           and not segment.discontinuity \
+           and segment.url == previous.url \
+           and previous.byterange[0] + previous.byterange[1] == segment.byterange[0] \
+           and previous.byterange[1] + segment.byterange[1] <= max_size:
+            coalesced[-1] = Segment(previous.url,
+                                    previous.duration + segment.duration,
+                                    previous.sequence,
+                                    (previous.byterange[0], previous.byterange[1] + segment.byterange[1]),
+                                    previous.discontinuity)
+        else:
+            coalesced.append(segment)
+
+    if len(coalesced) < len(segments):
+        logger.debug(f"Coalesced {len(segments)} byte range segments into {len(coalesced)} requests")
+    return coalesced
+
+
+def fetch_playlist(url:str, http:SessionPool) -> str:
+    response = http.get(url)
+    response.raise_for_status()
+    return response.text
+
+
+def fetch_master(url:str, http:SessionPool) -> MasterPlaylist:
+    text = fetch_playlist(url, http)
+    # Some sources point straight at a media playlist
+    if not is_master(text) and '#EXTINF' in text:
+        return MasterPlaylist(url, [Variant(url)], [])
+    return parse_master(text, url)
+
+
+def fetch_media(url:str, http:SessionPool) -> MediaPlaylist:
+    return parse_media(fetch_playlist(url, http), url)
+
+
+# `preference` is "max", "min" or a height such as 720 / "720p". Variants
+# above the height or above `max_bandwidth` (bits/s, 0 for no limit) are
+# left out, and if nothing is left the smallest variant is used.
+def select_variant(variants:list[Variant], preference:str | int="max", max_bandwidth:int=0) -> Variant:
+    if not variants:
+        raise ValueError("Playlist has no variants")
+
+    ranked = sorted(variants, key=lambda x: (x.height, x.bandwidth))
+    preference = str(preference).lower().rstrip('p')
+
+    candidates = [x for x in ranked if not max_bandwidth or x.bandwidth <= max_bandwidth]
+    if preference.isdigit():
+        candidates = [x for x in candidates if x.height <= int(preference)]
+    elif preference not in ("max", "min"):
+        logger.warning(f"Unknown video resolution {preference}, using the highest one")
+
+    if not candidates:
+        return ranked[0]
+    if preference == "min":
+        return candidates[0]
+    return candidates[-1]
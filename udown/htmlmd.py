@@ -0,0 +1,250 @@
+import re
+from html.parser import HTMLParser
+
+ESCAPED = re.compile(r'([\\`*_\[\]])')
+WHITESPACE = re.compile(r'\s+')
+# Elements whose end tag does more than end a block, they are tracked so
+# that mis-nested or missing end tags still close them in order
+CONTAINERS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'li', 'th', 'td', 'tr', 'table',
+              'ul', 'ol', 'strong', 'b', 'em', 'i', 'code', 'pre', 'a')
+# Elements html lets you leave open, the next sibling closes them unless
+# one of the scope elements is opened in between
+IMPLICIT_END = {'li': (('li',), ('ul', 'ol')),
+                'th': (('th', 'td'), ('tr', 'table')),
+                'td': (('th', 'td'), ('tr', 'table')),
+                'tr': (('tr',), ('table',))}
+
+
+# Converts article html to markdown in a single pass over the parser events.
+# Every element that needs its content before it can be written (links,
+# headings, list items, quotes, table cells) collects it in its own buffer,
+# everything else is written straight to the enclosing one.
+class MarkdownConverter(HTMLParser):
+    def __init__(self, image_location=None) -> None:
+        super().__init__(convert_charrefs=True)
+        # Called with every image source, returns what the markdown points at
+        self.image_location = image_location or (lambda src: src)
+        self.buffers:list[list[str]] = [[]]
+        self.links:list[str] = []
+        self.lists:list[list] = []
+        self.tables:list[list[list[str]]] = []
+        self.open:list[str] = []
+        self.pre = 0
+        self.code = 0
+        self.skip = 0
+
+    def write(self, text:str) -> None:
+        self.buffers[-1].append(text)
+
+    def push(self) -> None:
+        self.buffers.append([])
+
+    def pop(self) -> str:
+        return ''.join(self.buffers.pop())
+
+    def tail(self, length:int=2) -> str:
+        text = ""
+        for part in reversed(self.buffers[-1]):
+            text = part + text
+            if len(text) >= length:
+                break
+        return text[-length:]
+
+    def newline(self) -> None:
+        if self.buffers[-1] and self.tail(1) != '\n':
+            self.write('\n')
+
+    def block(self) -> None:
+        if not self.buffers[-1]:
+            return
+        tail = self.tail()
+        newlines = len(tail) - len(tail.rstrip('\n'))
+        self.write('\n' * (2 - newlines))
+
+    def wrap(self, marker:str) -> None:
+        text = self.pop()
+        stripped = text.strip()
+        if not stripped:
+            self.write(text)
+            return
+        lead = text[:len(text) - len(text.lstrip())]
+        trail = text[len(text.rstrip()):]
+        self.write(f"{lead}{marker}{stripped}{marker}{trail}")
+
+    def close(self, tag:str) -> None:
+        # Everything opened inside tag ends with it
+        while self.open:
+            open_tag = self.open.pop()
+            self.end(open_tag)
+            if open_tag == tag:
+                return
+
+    def close_implicit(self, tag:str) -> None:
+        if tag not in IMPLICIT_END:
+            return
+        siblings, scope = IMPLICIT_END[tag]
+        for open_tag in reversed(self.open):
+            if open_tag in scope:
+                return
+            if open_tag in siblings:
+                self.close(open_tag)
+                return
+
+    def handle_starttag(self, tag:str, attrs:list[tuple[str, str]]) -> None:
+        attrs = dict(attrs)
+        if tag in ('script', 'style'):
+            self.skip += 1
+            return
+        elif self.skip:
+            return
+
+        self.close_implicit(tag)
+        if tag in CONTAINERS:
+            self.open.append(tag)
+
+        if tag in ('p', 'div', 'section', 'article', 'figure'):
+            self.block()
+        elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'li', 'th', 'td'):
+            if tag == 'li' and self.lists:
+                self.lists[-1][1] += 1
+            self.push()
+        elif tag in ('strong', 'b', 'em', 'i'):
+            self.push()
+        elif tag == 'code' and not self.pre:
+            self.code += 1
+            self.push()
+        elif tag == 'pre':
+            self.pre += 1
+            self.push()
+        elif tag == 'a':
+            self.links.append(attrs.get('href') or "")
+            self.push()
+        elif tag == 'img':
+            src = attrs.get('src')
+            if src:
+                self.write(f"![{attrs.get('alt') or ''}]({self.image_location(src)})")
+        elif tag == 'br':
+            self.write('\n' if self.pre else '  \n')
+        elif tag == 'hr':
+            self.block()
+            self.write('---')
+            self.block()
+        elif tag in ('ul', 'ol'):
+            if self.lists:
+                self.newline()
+            else:
+                self.block()
+            self.lists.append([tag, 0])
+        elif tag == 'table':
+            self.block()
+            self.tables.append([])
+        elif tag == 'tr' and self.tables:
+            self.tables[-1].append([])
+
+    def handle_endtag(self, tag:str) -> None:
+        if tag in ('script', 'style'):
+            self.skip = max(0, self.skip - 1)
+        elif self.skip:
+            return
+        elif tag in CONTAINERS:
+            # An end tag without a matching open element is ignored
+            if tag in self.open:
+                self.close(tag)
+        else:
+            self.end(tag)
+
+    def end(self, tag:str) -> None:
+        if tag in ('p', 'div', 'section', 'article', 'figure'):
+            self.block()
+        elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6') and len(self.buffers) > 1:
+            text = WHITESPACE.sub(' ', self.pop()).strip()
+            self.block()
+            if text:
+                self.write(f"{'#' * int(tag[1])} {text}")
+            self.block()
+        elif tag == 'blockquote' and len(self.buffers) > 1:
+            text = self.pop().strip()
+            self.block()
+            self.write('\n'.join(f"> {line}".rstrip() for line in text.split('\n')))
+            self.block()
+        elif tag == 'li' and len(self.buffers) > 1:
+            text = self.pop().strip()
+            kind, count = self.lists[-1] if self.lists else ('ul', 1)
+            marker = f"{count}. " if kind == 'ol' else "- "
+            self.newline()
+            self.write(marker + text.replace('\n', '\n' + ' ' * len(marker)) + '\n')
+        elif tag in ('ul', 'ol') and self.lists:
+            self.lists.pop()
+            if not self.lists:
+                self.block()
+        elif tag in ('strong', 'b') and len(self.buffers) > 1:
+            self.wrap('**')
+        elif tag in ('em', 'i') and len(self.buffers) > 1:
+            self.wrap('*')
+        elif tag == 'code' and self.code:
+            self.code -= 1
+            text = self.pop()
+            fence = '``' if '`' in text else '`'
+            if text:
+                self.write(f"{fence}{text}{fence}")
+        elif tag == 'pre' and self.pre:
+            self.pre -= 1
+            text = self.pop().strip('\n')
+            self.block()
+            self.write(f"```\n{text}\n```")
+            self.block()
+        elif tag == 'a' and self.links:
+            href = self.links.pop()
+            text = self.pop()
+            if href and text.strip() and not href.startswith('#'):
+                self.write(f"[{text.strip()}]({href})")
+            else:
+                self.write(text)
+        elif tag in ('th', 'td') and len(self.buffers) > 1:
+            text = WHITESPACE.sub(' ', self.pop()).strip().replace('|', '\\|')
+            if self.tables and self.tables[-1]:
+                self.tables[-1][-1].append(text)
+        elif tag == 'table' and self.tables:
+            self.write_table(self.tables.pop())
+
+    def write_table(self, rows:list[list[str]]) -> None:
+        rows = [row for row in rows if row]
+        if not rows:
+            return
+        width = max(len(row) for row in rows)
+        rows = [row + [""] * (width - len(row)) for row in rows]
+        lines = [f"| {' | '.join(rows[0])} |", f"|{'---|' * width}"]
+        lines += [f"| {' | '.join(row)} |" for row in rows[1:]]
+        self.block()
+        self.write('\n'.join(lines))
+        self.block()
+
+    def handle_data(self, data:str) -> None:
+        if self.skip:
+            return
+        if self.pre or self.code:
+            self.write(data)
+            return
+
+        text = WHITESPACE.sub(' ', data)
+        # Whitespace at the start of a line means nothing in html
+        if not self.buffers[-1] or self.tail(1) == '\n':
+            text = text.lstrip()
+        if text:
+            self.write(ESCAPED.sub(r'\\\1', text))
+
+    def result(self) -> str:
+        super().close()
+        while self.open:
+            self.end(self.open.pop())
+        while len(self.buffers) > 1:
+            text = self.pop()
+            self.write(text)
+        text = re.sub(r'\n{3,}', '\n\n', self.pop())
+        return text.strip() + '\n'
+
+
+def html_to_markdown(html:str, image_location=None) -> str:
+    converter = MarkdownConverter(image_location)
+    converter.feed(html)
+    return converter.result()
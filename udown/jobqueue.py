@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+from enum import Enum
+from loguru import logger
+
+
+class JobState(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+# Courses and their lessons for batch runs, kept on disk so an interrupted
+# run picks up where it stopped. Lessons that were running when the process
+# died go back to pending on load.
+class JobQueue():
+    save_interval = 1.0
+
+    def __init__(self, location:str) -> None:
+        self.location = location
+        self.courses:dict[str, dict] = {}
+        self._lock = threading.RLock()
+        self._last_save = 0.0
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.location, 'r') as f:
+                self.courses = json.loads(f.read()).get('courses', {})
+        except FileNotFoundError:
+            self.courses = {}
+            return
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Could not parse job queue at {self.location}")
+            quit()
+
+        for course in self.courses.values():
+            course['state'] = JobState(course['state'])
+            for lesson in course['lessons'].values():
+                lesson['state'] = JobState(lesson['state'])
+
+        interrupted = 0
+        for course in self.courses.values():
+            if course['state'] == JobState.RUNNING:
+                course['state'] = JobState.PENDING
+            for lesson in course['lessons'].values():
+                if lesson['state'] == JobState.RUNNING:
+                    lesson['state'] = JobState.PENDING
+                    interrupted += 1
+        if interrupted:
+            logger.info(f"Requeued {interrupted} lessons that were interrupted")
+
+    def save(self) -> None:
+        with self._lock:
+            courses = {id: {**course, "state": course['state'].value,
+                            "lessons": {lesson_id: {**lesson, "state": lesson['state'].value} for lesson_id, lesson in course['lessons'].items()}}
+                       for id, course in self.courses.items()}
+            content = json.dumps({"courses": courses}, indent=1)
+            with open(self.location+'.tmp', 'w') as f:
+                f.write(content)
+            os.replace(self.location+'.tmp', self.location)
+            self._last_save = time.monotonic()
+
+    def add_course(self, id:int, title:str, url:str) -> bool:
+        with self._lock:
+            if str(id) in self.courses:
+                return False
+            self.courses[str(id)] = {"id": id, "title": title, "url": url, "state": JobState.PENDING,
+                                     "added": time.time(), "finished": None, "lessons": {}}
+            self.save()
+        return True
+
+    def pending_courses(self) -> list[dict]:
+        with self._lock:
+            return [course for course in self.courses.values() if course['state'] != JobState.DONE]
+
+    def course_state(self, course_id:int) -> JobState | None:
+        with self._lock:
+            course = self.courses.get(str(course_id))
+            return None if course is None else course['state']
+
+    def set_course_state(self, course_id:int, state:JobState) -> None:
+        with self._lock:
+            course = self.courses[str(course_id)]
+            course['state'] = state
+            course['finished'] = time.time() if state == JobState.DONE else None
+            self.save()
+
+    def sync_lessons(self, course_id:int, lessons:list) -> None:
+        with self._lock:
+            stored = self.courses[str(course_id)]['lessons']
+            for lesson in lessons:
+                stored.setdefault(str(lesson.id), {"title": lesson.title, "state": JobState.PENDING, "bytes": 0, "error": None})
+            self.save()
+
+    def lesson_state(self, course_id:int, lesson_id:int) -> JobState | None:
+        with self._lock:
+            lesson = self.courses.get(str(course_id), {}).get('lessons', {}).get(str(lesson_id))
+            return None if lesson is None else lesson['state']
+
+    def set_lesson_state(self, course_id:int, lesson_id:int, state:JobState, size:int=None, error:str=None) -> None:
+        with self._lock:
+            lesson = self.courses[str(course_id)]['lessons'].get(str(lesson_id))
+            if lesson is None:
+                return
+            lesson['state'] = state
+            lesson['error'] = error
+            if size is not None:
+                lesson['bytes'] = size
+            # Saving on every lesson would rewrite the whole queue for each
+            # one, a lost state is recovered from the outputs on the next run
+            if time.monotonic() - self._last_save > self.save_interval:
+                self.save()
+
+    def finish_courses(self) -> None:
+        with self._lock:
+            for course in self.courses.values():
+                states = [lesson['state'] for lesson in course['lessons'].values()]
+                if states and all(state == JobState.DONE for state in states):
+                    course['state'] = JobState.DONE
+                    course['finished'] = course['finished'] or time.time()
+                elif JobState.FAILED in states:
+                    course['state'] = JobState.FAILED
+            self.save()
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+from loguru import logger
+
+
+def strip_query(url:str) -> str:
+    # Signed CDN urls get a new token on every run, the path stays the same
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+def remove_segments(work_dir:str) -> None:
+    removed = 0
+    for file_name in os.listdir(work_dir):
+        if file_name.endswith(('.ts', '.part')):
+            os.remove(os.path.join(work_dir, file_name))
+            removed += 1
+    if removed:
+        logger.debug(f"Removed {removed} stale segment files from {work_dir}")
+
+
+class SegmentManifest():
+    file_name = "manifest.json"
+    save_interval = 1.0
+
+    def __init__(self, location:str, stream_url:str, segments:list[dict]) -> None:
+        self.location = location
+        self.stream_url = stream_url
+        self.segments = segments
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, work_dir:str, stream_url:str, segment_urls:list[str], byteranges:list[tuple[int, int]]=None) -> "SegmentManifest":
+        location = os.path.join(work_dir, cls.file_name)
+        byteranges = byteranges or [None] * len(segment_urls)
+        # Stored as lists so they compare equal to what json gives back
+        segments = [{"index": i, "url": url, "byterange": list(byterange) if byterange else None, "size": None, "completed": False}
+                    for i, (url, byterange) in enumerate(zip(segment_urls, byteranges))]
+
+        try:
+            with open(location, 'r') as f:
+                stored = json.loads(f.read())
+        except FileNotFoundError:
+            stored = None
+        except json.decoder.JSONDecodeError:
+            logger.warning(f"Could not parse segment manifest at {location}, starting over.")
+            stored = None
+
+        resumed = False
+        if stored is not None:
+            stored_segments = stored.get('segments', [])
+            same_stream = strip_query(stored.get('stream_url', "")) == strip_query(stream_url) \
+                          and [(strip_query(x['url']), x.get('byterange')) for x in stored_segments] \
+                              == [(strip_query(x['url']), x['byterange']) for x in segments]
+            if same_stream:
+                for segment, stored_segment in zip(segments, stored_segments):
+                    segment['size'] = stored_segment.get('size')
+                    segment['completed'] = stored_segment.get('completed', False)
+                resumed = True
+                logger.debug(f"Resuming from manifest with {sum(x['completed'] for x in segments)}/{len(segments)} completed segments")
+            else:
+                logger.info(f"Stream changed since the last run, discarding manifest at {location}")
+
+        # Without a manifest to vouch for them, segments left in the work
+        # directory may belong to another stream and must not be muxed
+        if not resumed:
+            remove_segments(work_dir)
+
+        manifest = cls(location, stream_url, segments)
+        manifest.save()
+        return manifest
+
+    def save(self) -> None:
+        with self._lock:
+            content = json.dumps({"stream_url": self.stream_url, "segments": self.segments})
+            with open(self.location+'.tmp', 'w') as f:
+                f.write(content)
+            os.replace(self.location+'.tmp', self.location)
+            self._last_save = time.monotonic()
+
+    def verify(self, index:int, file_path:str) -> bool:
+        segment = self.segments[index]
+        try:
+            size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            return False
+
+        if segment['completed']:
+            return size == segment['size']
+
+        # Segments only get their final name once fully downloaded, the
+        # manifest was just not saved before the last run stopped.
+        with self._lock:
+            segment['size'] = size
+            segment['completed'] = True
+        return True
+
+    def unverified(self, segment_file) -> list[int]:
+        return [segment['index'] for segment in self.segments if not self.verify(segment['index'], segment_file(segment['index']))]
+
+    def mark_completed(self, index:int, size:int) -> None:
+        with self._lock:
+            self.segments[index]['size'] = size
+            self.segments[index]['completed'] = True
+            due = time.monotonic() - self._last_save > self.save_interval
+        # Saving on every segment would rewrite the whole file hundreds of times
+        if due:
+            self.save()
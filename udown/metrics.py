@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+
+class StageTimer():
+    def __init__(self, metrics:"Metrics", stage:str) -> None:
+        self.metrics = metrics
+        self.stage = stage
+        self.bytes = 0
+
+    def __enter__(self) -> "StageTimer":
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.metrics.record(self.stage, time.monotonic() - self.started, self.bytes, failed=exc_type is not None)
+
+
+# Collects durations, byte counts, errors and retries per pipeline stage for
+# one run, and writes them out as a json line and as prometheus text.
+class Metrics():
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.bytes = Counter()
+        self.errors = Counter()
+        self.retries = Counter()
+        self._lock = threading.Lock()
+
+    def stage(self, stage:str) -> StageTimer:
+        return StageTimer(self, stage)
+
+    def record(self, stage:str, seconds:float, size:int=0, failed:bool=False) -> None:
+        with self._lock:
+            self.calls[stage] += 1
+            self.seconds[stage] += seconds
+            self.bytes[stage] += size
+            if failed:
+                self.errors[stage] += 1
+
+    def retry(self, stage:str) -> None:
+        with self._lock:
+            self.retries[stage] += 1
+
+    def timed(self, stage:str, function):
+        # Wraps a download function, its result is either a size or the content
+        def wrapper(*args, **kwargs):
+            with self.stage(stage) as timer:
+                result = function(*args, **kwargs)
+                timer.bytes = len(result) if isinstance(result, bytes) else result if isinstance(result, int) else 0
+            return result
+        return wrapper
+
+    def report(self, cache_stats:dict[str, dict]=None, **extra) -> dict:
+        with self._lock:
+            stages = {}
+            for stage in self.calls:
+                stages[stage] = {"calls": self.calls[stage],
+                                 "seconds": round(self.seconds[stage], 3),
+                                 "bytes": self.bytes[stage],
+                                 "bytes_per_second": round(self.bytes[stage] / self.seconds[stage]) if self.seconds[stage] else 0,
+                                 "errors": self.errors[stage],
+                                 "retries": self.retries[stage]}
+
+        cache = {}
+        for role, counts in (cache_stats or {}).items():
+            lookups = counts['hits'] + counts['misses']
+            if lookups:
+                cache[role] = dict(counts, hit_ratio=round(counts['hits'] / lookups, 3))
+
+        return {"started": self.started,
+                "elapsed": round(time.time() - self.started, 3),
+                "stages": stages,
+                "cache": cache,
+                **extra}
+
+    def write_jsonl(self, location:str, report:dict) -> None:
+        with open(location, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+    def write_prometheus(self, location:str, report:dict) -> None:
+        lines = []
+
+        def metric(name:str, help:str, kind:str, samples:list[tuple[str, float]]) -> None:
+            lines.append(f"# HELP udown_{name} {help}")
+            lines.append(f"# TYPE udown_{name} {kind}")
+            lines.extend(f"udown_{name}{labels} {value}" for labels, value in samples)
+
+        stages = report['stages']
+        metric("stage_calls_total", "Calls per pipeline stage.", "counter",
+               [(f'{{stage="{stage}"}}', x['calls']) for stage, x in stages.items()])
+        metric("stage_seconds_total", "Time spent per pipeline stage.", "counter",
+               [(f'{{stage="{stage}"}}', x['seconds']) for stage, x in stages.items()])
+        metric("stage_bytes_total", "Bytes transferred per pipeline stage.", "counter",
+               [(f'{{stage="{stage}"}}', x['bytes']) for stage, x in stages.items()])
+        metric("stage_errors_total", "Failed calls per pipeline stage.", "counter",
+               [(f'{{stage="{stage}"}}', x['errors']) for stage, x in stages.items()])
+        metric("stage_retries_total", "Retries per pipeline stage.", "counter",
+               [(f'{{stage="{stage}"}}', x['retries']) for stage, x in stages.items()])
+        metric("cache_hit_ratio", "Cache hit ratio per role.", "gauge",
+               [(f'{{role="{role}"}}', x['hit_ratio']) for role, x in report['cache'].items()])
+        metric("run_seconds", "Duration of the run.", "gauge", [("", report['elapsed'])])
+
+        # Written next to the target and renamed, so a collector never reads half a file
+        with open(location+'.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(location+'.tmp', location)
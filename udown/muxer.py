@@ -0,0 +1,89 @@
+import threading
+import subprocess
+from loguru import logger
+
+from rich.progress import Progress, TaskID
+
+
+class MuxJob():
+    def __init__(self, command:list[str], progress:Progress=None, task:TaskID=None, duration:float=None, stdin:bool=False) -> None:
+        self.command = command
+        self.progress = progress
+        self.task = task
+        self.duration = duration
+        self.stderr = []
+
+        logger.debug(command)
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        text=False)
+        self.stdin = self.process.stdin
+
+        self._readers = [threading.Thread(target=self._read_progress, daemon=True),
+                         threading.Thread(target=self._read_errors, daemon=True)]
+        for reader in self._readers:
+            reader.start()
+
+    def _read_progress(self) -> None:
+        # -progress writes key=value blocks, out_time_us is the muxed position
+        for line in self.process.stdout:
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            if self.progress is None or self.task is None:
+                continue
+            if key == 'out_time_us' and value.isdigit():
+                self.progress.update(self.task, completed=int(value) / 1_000_000)
+            elif key == 'progress' and value == 'end' and self.duration:
+                self.progress.update(self.task, completed=self.duration)
+
+    def _read_errors(self) -> None:
+        for line in self.process.stderr:
+            self.stderr.append(line.decode(errors='replace').rstrip())
+            del self.stderr[:-20]
+
+    def remove_task(self) -> None:
+        if self.progress is not None and self.task is not None:
+            self.progress.remove_task(self.task)
+            self.task = None
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        for reader in self._readers:
+            reader.join()
+        self.remove_task()
+
+    def wait(self) -> int:
+        if self.stdin is not None and not self.stdin.closed:
+            self.stdin.close()
+        returncode = self.process.wait()
+        for reader in self._readers:
+            reader.join()
+        self.remove_task()
+
+        if returncode != 0:
+            error = "\n".join(self.stderr)
+            raise RuntimeError(f"ffmpeg exited with code {returncode}: {error}")
+        return returncode
+
+
+class MuxPool():
+    def __init__(self, max_jobs:int=1, ffmpeg_path:str="ffmpeg") -> None:
+        self.max_jobs = max_jobs
+        self.ffmpeg_path = ffmpeg_path
+        self.slots = threading.BoundedSemaphore(max_jobs)
+
+    def command(self, args:list[str]) -> list[str]:
+        return [self.ffmpeg_path, '-hide_banner', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', '-y', *args]
+
+    def start(self, args:list[str], progress:Progress=None, description:str="Muxing", duration:float=None, stdin:bool=False) -> MuxJob:
+        task = None
+        if progress is not None:
+            task = progress.add_task(f"[green]{description}", total=duration)
+        return MuxJob(self.command(args), progress, task, duration, stdin)
+
+    def run(self, args:list[str], progress:Progress=None, description:str="Muxing", duration:float=None) -> None:
+        # Blocking remuxes are CPU and disk bound, so only max_jobs run at once
+        with self.slots:
+            self.start(args, progress, description, duration).wait()
@@ -1,18 +1,24 @@
-import json
 import os
 import undetected_chromedriver as webdriver
 from loguru import logger
 from enum import Enum
-import requests
-import re
+import shutil
 import concurrent.futures
+import functools
+import requests
+from urllib.parse import urlsplit
 
 from rich.progress import Progress
 
 from settings import SettingsManager, CacheRole
 from web import request_xhr
-from utils import slugify, parse_m3u, get_filename_from_link, download_ts
-from api import fetch_lesson_data, fetch_article_body
+from utils import slugify, download_ts, fetch_segment, try_lock, with_retries, SegmentError
+from manifest import SegmentManifest
+from captions import filter_captions
+from snapshot import article_files
+from hls import Segment, fetch_master, fetch_media, select_variant, coalesce_segments
+from htmlmd import html_to_markdown
+from api import fetch_lesson_data, fetch_lessons_data, fetch_article_body, fetch_article_bodies
 
 
 class Course():
@@ -32,8 +38,11 @@ class Course():
         else:
             self.__lookup__(driver, settings)
 
-    def fetch(self, driver:webdriver, settings:SettingsManager) -> None:
+    def fetch(self, driver:webdriver, settings:SettingsManager, refresh:bool=False, prefetch:bool=True) -> None:
         logger.debug(f"Requesting Course Content for {self.title} ({self.id})")
+        if refresh:
+            # The curriculum is cached for weeks, a sync has to see the current one
+            settings.cache.delete(CacheRole.courseContent, self.id, missing_ok=True)
         try:
             _ = request_xhr(driver, 
                             f"https://www.udemy.com/api-2.0/courses/{self.id}/subscriber-curriculum-items/?page_size=1200&fields%5Blecture%5D=title,object_index,asset,supplementary_assets&fields%5Bquiz%5D=title,object_index,is_published,sort_order,type&fields%5Bpractice%5D=title,object_index,is_published,sort_order&fields%5Bchapter%5D=title,object_index,is_published,sort_order&fields%5Basset%5D=title,filename,asset_type,is_external&caching_intent=True",
@@ -67,6 +76,7 @@ class Course():
             
             if item['_class'] == "lecture":
                 title = item['title']
+                asset_id = item['asset'].get('id')
                 match item['asset']['asset_type']:                
                     case "Video":
                         lesson_type = LessonType.VIDEO
@@ -82,12 +92,37 @@ class Course():
                     lesson_type=lesson_type,
                     course_index=item['object_index'],
                     hierarchal_index=(current_section, section_lesson),
-                    filename=filename
+                    filename=filename,
+                    asset_id=asset_id
                 ))
                 section_lesson+=1
         
         self.content = sections
         logger.success(f"Parsed {len(self.content)} course sections.")
+
+        if settings.download_prefetch and prefetch:
+            self.prefetch(driver, settings)
+
+    def prefetch(self, driver:webdriver, settings:SettingsManager) -> None:
+        lessons = [lesson for section in self.content for lesson in section['lessons']
+                   if not os.path.exists(lesson.resolve_download_location(settings))]
+        if not lessons:
+            return
+
+        # Articles only need their body, which is fetched by asset id without
+        # going through the lecture first
+        articles = {lesson.id: lesson.asset_id for lesson in lessons
+                    if lesson.lesson_type == LessonType.ARTICLE and lesson.asset_id is not None}
+        videos = [lesson.id for lesson in lessons if lesson.id not in articles]
+
+        if videos:
+            logger.debug(f"Prefetching lesson data for {len(videos)} lessons")
+            data = fetch_lessons_data(self.id, videos, driver, settings, settings.download_prefetch_concurrency)
+            logger.success(f"Prefetched lesson data for {len(data)}/{len(videos)} lessons.")
+        if articles:
+            logger.debug(f"Prefetching {len(articles)} articles")
+            data = fetch_article_bodies(self.id, articles, driver, settings, settings.download_prefetch_concurrency)
+            logger.success(f"Prefetched {len(data)}/{len(articles)} articles.")
     
     def __lookup__(self, driver, settings:SettingsManager):
         logger.debug("Fetching course information")
@@ -104,13 +139,10 @@ class Course():
         logger.debug(f"Fetched data: ID={self.id} TITLE={self.title} URL={self.url}")
 
     def __dump_lookup__(self, settings:SettingsManager) -> None:
-        dump_loc = os.path.join(settings.cache.directory, CacheRole.courseIdLookup.name, str(self.id))
-
-        if os.path.exists(dump_loc):
+        if settings.cache.read(CacheRole.courseIdLookup, self.id) is not None:
             return
         
-        with open(dump_loc, "w") as f:
-            f.write(json.dumps({"_class":"course", "id": self.id, "title": self.title, "url": self.url.split(".com")}))
+        settings.cache.write(CacheRole.courseIdLookup, self.id, {"_class":"course", "id": self.id, "title": self.title, "url": self.url.split(".com")[-1]})
 
 class LessonType(Enum):
     VIDEO = 'VIDEO'
@@ -118,7 +150,7 @@ class LessonType(Enum):
 
 class Lesson():
     url = "https://www.udemy.com/$course-slug/learn/lecture/$lesson-id"
-    def __init__(self, id:int, course:Course, title:str="Lesson Title", lesson_type:LessonType=LessonType.VIDEO, course_index:int=0, hierarchal_index:tuple[int]=(0,0), filename:str = "lesson.mp4"):
+    def __init__(self, id:int, course:Course, title:str="Lesson Title", lesson_type:LessonType=LessonType.VIDEO, course_index:int=0, hierarchal_index:tuple[int]=(0,0), filename:str = "lesson.mp4", asset_id:int=None):
         self.id = id
         self.course = course
 
@@ -127,147 +159,460 @@ class Lesson():
         self.course_index = course_index
         self.h_index = hierarchal_index
         self.filename = filename
+        self.asset_id = asset_id
 
         self.url = self.url.replace('$course-slug', self.course.slug) \
                             .replace('$lesson-id', str(self.id))
+
+        self.section = None
+        self.download_location = None
+        self.work_dir = None
+        self.lock_fd = None
+        self.lesson_data = None
+        self.stream_segments:list[Segment] = []
+        self.stream_segment_urls = []
+        self.stream_duration = 0.0
+        self.stream_bandwidth = 0
+        self.video_count = 0
+        self.manifest = None
+        self.caption_futures:list[tuple[dict, concurrent.futures.Future]] = []
+        self.caption_files:list[tuple[str, str]] = []
     
     def get_section(self) -> dict:
+        if self.section is not None:
+            return self.section
         for section in self.course.content:
             if self in section['lessons']:
+                self.section = section
                 return section    
         logger.error(f"Could not find section containing {self.title}")
 
-    def download(self, settings:SettingsManager, driver:webdriver) -> None:
-        logger.debug(f"Download {self.title}")
-
+    def resolve_download_location(self, settings:SettingsManager) -> str:
         if self.lesson_type == LessonType.VIDEO:
             ext = "mkv"
         elif self.lesson_type == LessonType.ARTICLE:
-            ext = "html"
-
-        download_location = settings.download_location.replace('$course-slug', self.course.slug) \
-                                                      .replace('$section-slug', slugify(self.get_section()['title'])) \
-                                                      .replace('$ind-section-slug', f"{self.h_index[0]}-{slugify(self.get_section()['title'])}") \
-                                                      .replace('$lesson-slug', slugify(self.title)) \
-                                                      .replace('$ind-lesson-slug', f"{self.h_index[0]}.{self.h_index[1]}-{slugify(self.title)}") \
-                                                      .replace('$ext', ext)
-        
-        logger.debug(f"Set download location as {download_location}")
-        os.makedirs(os.path.dirname(download_location), exist_ok=True)
+            ext = "md" if settings.download_article_format == "markdown" else "html"
+
+        section_slug = slugify(self.get_section()['title'])
+        return settings.download_location.replace('$course-slug', self.course.slug) \
+                                         .replace('$section-slug', section_slug) \
+                                         .replace('$ind-section-slug', f"{self.h_index[0]}-{section_slug}") \
+                                         .replace('$lesson-slug', slugify(self.title)) \
+                                         .replace('$ind-lesson-slug', f"{self.h_index[0]}.{self.h_index[1]}-{slugify(self.title)}") \
+                                         .replace('$ext', ext)
+
+    def segment_file(self, index:int) -> str:
+        # Segments of a separate audio rendition follow the video ones
+        if index >= self.video_count:
+            return os.path.join(self.work_dir, f"audio_{index - self.video_count:05d}.ts")
+        return os.path.join(self.work_dir, f"segment_{index:05d}.ts")
+
+    def audio_indices(self) -> range:
+        return range(self.video_count, len(self.stream_segment_urls))
+
+    def write_concat_list(self, name:str, indices:range) -> str:
+        # ffmpeg resolves the relative entries against the list's own directory
+        location = os.path.join(self.work_dir, name)
+        with open(location, 'w') as f:
+            f.writelines([f"file '{os.path.basename(self.segment_file(i))}'\n" for i in indices])
+        return location
+
+    def partial_output(self) -> str:
+        # ffmpeg writes here and the file only gets its final name once
+        # complete, a half muxed file must never look like a finished lesson.
+        # It sits next to the output so the rename never crosses filesystems.
+        return self.download_location + '.part'
+
+    def remove_partial_output(self) -> None:
+        try:
+            os.remove(self.partial_output())
+        except FileNotFoundError:
+            pass
+
+    def claim_work_dir(self, settings:SettingsManager) -> bool:
+        self.work_dir = os.path.join(settings.download_work_directory, str(self.course.id), str(self.id))
+
+        # The lock on this file keeps a second process from working on the
+        # same lesson. A lock left by a process that died is released by the
+        # OS, so there is no stale lock to take over.
+        lock_file = os.path.join(self.work_dir, ".lock")
+        while True:
+            os.makedirs(self.work_dir, exist_ok=True)
+            fd = os.open(lock_file, os.O_CREAT | os.O_RDWR)
+            if not try_lock(fd):
+                os.close(fd)
+                try:
+                    with open(lock_file, 'r') as f:
+                        owner = f.read().strip() or "another process"
+                except OSError:
+                    owner = "another process"
+                logger.warning(f"Lesson{self.h_index[0]}.{self.h_index[1]} {self.title} is being downloaded by process {owner}, skipping.")
+                return False
+
+            # The previous owner may have removed the file between our open
+            # and lock, a lock on a removed file protects nothing
+            try:
+                current = os.path.samestat(os.fstat(fd), os.stat(lock_file))
+            except FileNotFoundError:
+                current = False
+            if not current:
+                os.close(fd)
+                continue
 
-        if os.path.exists(download_location):
-            logger.success(f"Downloaded Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
-            return
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode())
+            self.lock_fd = fd
+            return True
 
-        lesson_data = fetch_lesson_data(self.course.id, self.id, driver, settings)
+    def release_work_dir(self, settings:SettingsManager, success:bool) -> None:
+        if self.work_dir is None:
+            return
 
-        if self.lesson_type == LessonType.VIDEO:
-            stream_id = int(f"{self.course.id}{self.id}")
-
-            stream_qualities_url = lesson_data['asset']['media_sources'][0]['src']
-
-            # Get streams
-            content = requests.get(stream_qualities_url).text
-
-            video_streams = []
-            for stream in content.split('#EXT-X-STREAM-INF:')[1:]:
-                stream = {
-                    "url": stream.split('\n')[1],
-                    "resolution": re.search(r'RESOLUTION=([0-9]+x[0-9]+)', stream).group(1),
-                    "bandwidth": re.search(r'BANDWIDTH=([0-9]+)', stream).group(1),
-                    "frame_rate": re.search(r'FRAME-RATE=([0-9]+)', stream).group(1),
-                    "codecs": re.search(r'CODECS="([^"]+)"', stream).group(1)
-                }
-                video_streams.append(stream)
-            
+        match settings.download_cleanup:
+            case "always":
+                remove = True
+            case "on_success":
+                remove = success
+            case _:
+                remove = False
+
+        # The lock file is removed before the lock is released, so a process
+        # waiting on it notices it locked a file that is gone
+        if remove:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            logger.debug(f"Removed work directory {self.work_dir}")
+        else:
             try:
-                match settings.download_video_resolution:
-                    case "max":
-                        sel_stream = video_streams[-1]
-                    case _:
-                        sel_stream = video_streams[0]
-            except IndexError:
-                logger.error("Stream data cache has expired and is no longer valid. Fetching stream again.")
-                settings.cache.delete(CacheRole.lessonStreams, stream_id)
-                logger.debug(f"Deleted cache {CacheRole.lessonStreams.name}:{stream_id}")
-                return self.download(settings, driver)
-            
-            logger.info(f"Selected Stream: {sel_stream['resolution']} CODEC: {sel_stream['codecs']}")
-            
-            # Download stream
-            stream_segment_urls = parse_m3u(stream['url'])
-            stream_segment_files = [f"file '{get_filename_from_link(x)}.ts'\n" for x in stream_segment_urls]
-            with open('.udownsegments', 'w') as f:
-                f.writelines(stream_segment_files)
-            
-            # Start Download
-            with Progress() as progress:
-                task1 = progress.add_task("[red]Downloading lesson...", total=len(stream_segment_urls))
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=settings.download_threads) as executor:
-                    future_to_url = {executor.submit(download_ts, url): url for url in stream_segment_urls}
-                    
-                    for future in concurrent.futures.as_completed(future_to_url):
-                        url = future_to_url[future]
-                        try:
-                            future.result()
-                        except Exception as e:
-                            print(f"Error downloading {url}: {str(e)}") 
-                        else:
-                            progress.update(task1, advance=1)
-            logger.debug(f"Downloaded Stream segments for Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
-
-            caption_ffmpeg = ""
-            caption_input = ""
-            caption_map = ""
-            caption_metadata = ""
-
-            # Download captions
-            if settings.download_captions:
-                caption_streams = lesson_data['asset']['captions']
-
-                caption_files = []
-                # Save captions
-                logger.debug(f"Downloading {len(caption_streams)} caption streams")
-                for caption_stream in caption_streams:
-                    i = caption_streams.index(caption_stream)
-                    file_name = f"sub_{caption_stream['locale_id']}.vtt"
-
-                    if not os.path.exists(file_name):
-                        with open(file_name, 'wb') as subfile:
-                            subfile.write(requests.get(caption_stream['url']).content)
-                    caption_files.append(file_name)
-
-                    caption_input += f"-i {file_name} "
-                    caption_map += f"-map {i} "
-                    caption_metadata += f"-metadata:s:s:{i} language={caption_stream['video_label'].split(' ')[0]} "
-                    logger.debug(f"Downloaded {caption_stream['video_label']} captions")
-                
-                caption_ffmpeg = caption_input + caption_map + caption_metadata
-
-            # Merge into single file
-            ffmpeg_command = f'ffmpeg -f concat -i .udownsegments {caption_ffmpeg} -acodec copy -vcodec copy "{download_location}"'
-            logger.debug(ffmpeg_command)
-            os.system(ffmpeg_command)
-
-            # Clean Up
-            for file in stream_segment_files:
-                file_path = file.split("'")[1].split("'")[0]
-                try:
-                    os.remove(file_path)
-                except:
-                    logger.error(f"Could not remove {file_path}")
-            logger.debug("Removed stream segments.")
-            os.remove('.udownsegments')
-            for file in caption_files:
-                os.remove(file)
-        
-        elif self.lesson_type == LessonType.ARTICLE:
-            asset_id = lesson_data['asset']['id']
-            lesson_body = fetch_article_body(asset_id, self.id, self.course.id, driver, settings)
+                os.remove(os.path.join(self.work_dir, ".lock"))
+            except OSError:
+                pass
+            logger.debug(f"Kept work directory {self.work_dir}")
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        self.work_dir = None
+
+    def prepare(self, settings:SettingsManager, driver:webdriver) -> bool:
+        self.download_location = self.resolve_download_location(settings)
+        logger.debug(f"Set download location as {self.download_location}")
+        os.makedirs(os.path.dirname(self.download_location), exist_ok=True)
+
+        if os.path.exists(self.download_location):
+            logger.success(f"Downloaded Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
+            return False
+
+        if self.lesson_type == LessonType.VIDEO and not self.claim_work_dir(settings):
+            return False
+
+        if self.lesson_type == LessonType.ARTICLE:
+            if self.asset_id is None:
+                self.lesson_data = fetch_lesson_data(self.course.id, self.id, driver, settings)
+                self.asset_id = self.lesson_data['asset']['id']
+            return True
 
-            with open(download_location, 'w') as f:
-                f.write(lesson_body['body'])
+        try:
+            self.lesson_data = fetch_lesson_data(self.course.id, self.id, driver, settings)
+            return self.select_stream(settings, driver)
+        except Exception:
+            self.release_work_dir(settings, False)
+            raise
+
+    def select_stream(self, settings:SettingsManager, driver:webdriver, refetch:bool=True) -> bool:
+        stream_id = int(f"{self.course.id}{self.id}")
+
+        stream_qualities_url = self.lesson_data['asset']['media_sources'][0]['src']
+
+        # Get streams
+        try:
+            with settings.metrics.stage("playlist"):
+                master = fetch_master(stream_qualities_url, settings.http)
+        except requests.RequestException:
+            master = None
+
+        if master is None or not master.variants:
+            if not refetch:
+                raise RuntimeError(f"No playable streams for Lesson{self.h_index[0]}.{self.h_index[1]}")
+            logger.error("Stream data cache has expired and is no longer valid. Fetching stream again.")
+            settings.cache.delete(CacheRole.lessonStreams, stream_id)
+            logger.debug(f"Deleted cache {CacheRole.lessonStreams.name}:{stream_id}")
+            self.lesson_data = fetch_lesson_data(self.course.id, self.id, driver, settings)
+            return self.select_stream(settings, driver, refetch=False)
+
+        sel_stream = select_variant(master.variants, settings.download_video_resolution, settings.download_max_bandwidth)
+        logger.info(f"Selected Stream: {sel_stream.resolution} ({sel_stream.bandwidth // 1000} kbps) CODEC: {sel_stream.codecs}")
+
+        with settings.metrics.stage("playlist"):
+            media = fetch_media(sel_stream.url, settings.http)
+        if media.encryption is not None:
+            raise RuntimeError(f"Stream is encrypted with {media.encryption}, which is not supported")
+        if media.init_url is not None:
+            raise RuntimeError("Fragmented mp4 streams are not supported")
+
+        # Each entry is one request and one file in the work directory
+        self.stream_segments = coalesce_segments(media.segments, settings.download_coalesce_size)
+        self.video_count = len(self.stream_segments)
+
+        # A separate audio rendition is downloaded like the video and muxed next to it
+        audio = master.audio_rendition(sel_stream)
+        if audio is not None:
+            logger.info(f"Selected audio: {audio.name} ({audio.language})")
+            with settings.metrics.stage("playlist"):
+                audio_media = fetch_media(audio.url, settings.http)
+            if audio_media.encryption is not None:
+                raise RuntimeError(f"Audio is encrypted with {audio_media.encryption}, which is not supported")
+            self.stream_segments += coalesce_segments(audio_media.segments, settings.download_coalesce_size)
+        self.stream_segment_urls = [segment.url for segment in self.stream_segments]
+        self.stream_duration = media.duration
+        self.stream_bandwidth = sel_stream.bandwidth
+        self.manifest = SegmentManifest.load(self.work_dir, sel_stream.url, self.stream_segment_urls,
+                                             [segment.byterange for segment in self.stream_segments])
+        return True
+
+    def submit_download(self, settings:SettingsManager, executor:concurrent.futures.Executor, index:int) -> concurrent.futures.Future:
+        segment = self.stream_segments[index]
+        if settings.async_engine is not None:
+            return settings.async_engine.download(segment.url, self.segment_file(index), segment.byterange)
+        # The limiter wraps single attempts, a segment waiting out its backoff does not hold a slot
+        function = settings.metrics.timed("segment_fetch", download_ts)
+        if settings.concurrency is not None:
+            function = functools.partial(settings.concurrency.call, function)
+        return executor.submit(with_retries, function, segment.url, self.segment_file(index), settings.segment_http, settings.download_chunk_size, settings.download_verify_segments, segment.byterange,
+                               retries=settings.download_segment_retries, backoff=settings.download_segment_backoff,
+                               on_retry=functools.partial(settings.metrics.retry, "segment_fetch"))
+
+    def submit_fetch(self, settings:SettingsManager, executor:concurrent.futures.Executor, index:int) -> concurrent.futures.Future:
+        segment = self.stream_segments[index]
+        if settings.async_engine is not None:
+            return settings.async_engine.fetch(segment.url, segment.byterange)
+        function = settings.metrics.timed("segment_fetch", fetch_segment)
+        if settings.concurrency is not None:
+            function = functools.partial(settings.concurrency.call, function)
+        return executor.submit(with_retries, function, segment.url, settings.segment_http, settings.download_verify_segments, segment.byterange,
+                               retries=settings.download_segment_retries, backoff=settings.download_segment_backoff,
+                               on_retry=functools.partial(settings.metrics.retry, "segment_fetch"))
+
+    def estimate_size(self, index:int, average:int) -> int:
+        segment = self.stream_segments[index]
+        if segment.byterange is not None:
+            return segment.byterange[1]
+        if average:
+            return average
+        # Before the first segment arrives the variant's bandwidth is the best guess
+        return int(segment.duration * self.stream_bandwidth / 8)
+
+    def fetch_segments(self, settings:SettingsManager, executor:concurrent.futures.Executor, progress:Progress, indices:range=None) -> None:
+        if indices is None:
+            indices = range(len(self.stream_segment_urls))
+        pending = []
+        for i in indices:
+            if self.manifest.verify(i, self.segment_file(i)):
+                continue
+            # A segment that no longer matches the manifest cannot be trusted
+            if os.path.exists(self.segment_file(i)):
+                os.remove(self.segment_file(i))
+            pending.append(i)
+
+        task = progress.add_task(f"[red]Lesson{self.h_index[0]}.{self.h_index[1]}", 
+                                 total=len(indices), 
+                                 completed=len(indices) - len(pending))
+        if len(pending) < len(indices):
+            logger.info(f"Resuming Lesson{self.h_index[0]}.{self.h_index[1]} with {len(pending)} of {len(indices)} segments left")
+
+        future_to_index = {self.submit_download(settings, executor, i): i for i in pending}
         
-        logger.success(f"Downloaded Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
-            
\ No newline at end of file
+        failed = []
+        try:
+            for future in concurrent.futures.as_completed(future_to_index):
+                i = future_to_index[future]
+                try:
+                    size = future.result()
+                except Exception as e:
+                    logger.error(f"Could not download segment {i} of Lesson{self.h_index[0]}.{self.h_index[1]}: {e}")
+                    failed.append(i)
+                else:
+                    self.manifest.mark_completed(i, size)
+                    progress.update(task, advance=1)
+        finally:
+            progress.remove_task(task)
+        self.manifest.save()
+
+        # Finished segments stay in the work directory, a rerun only fetches these
+        if failed:
+            raise SegmentError(f"{len(failed)} of {len(indices)} segments failed")
+        logger.debug(f"Downloaded Stream segments for Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
+
+    def fetch_captions(self, settings:SettingsManager, executor:concurrent.futures.Executor) -> None:
+        # Only starts the downloads, they run next to the segments and are
+        # collected by wait_captions before muxing
+        self.caption_futures = []
+        self.caption_files = []
+
+        if not settings.download_captions:
+            return
+
+        caption_streams = filter_captions(self.lesson_data['asset'].get('captions', []), settings.download_caption_locales)
+        logger.debug(f"Fetching {len(caption_streams)} caption streams")
+        self.caption_futures = [(caption_stream, settings.captions.fetch(caption_stream, executor)) for caption_stream in caption_streams]
+
+    def wait_captions(self) -> None:
+        self.caption_files = []
+        for caption_stream, future in self.caption_futures:
+            try:
+                file_name = future.result()
+            except Exception as e:
+                logger.warning(f"Could not download {caption_stream['video_label']} captions for Lesson{self.h_index[0]}.{self.h_index[1]}: {e}")
+                continue
+            self.caption_files.append((file_name, caption_stream['video_label'].split(' ')[0]))
+
+    def mux_args(self) -> list[str]:
+        inputs = []
+        maps = ['-map', '0']
+        metadata = []
+        if self.audio_indices():
+            # The audio segments were downloaded next to the video ones
+            inputs += ['-f', 'concat', '-i', self.write_concat_list("audio.txt", self.audio_indices())]
+            maps = ['-map', '0:v', '-map', '1:a']
+
+        for i, (file_name, language) in enumerate(self.caption_files):
+            inputs += ['-i', file_name]
+            # Input 0 is the video, the rest are counted in order
+            maps += ['-map', str(inputs.count('-i'))]
+            metadata += [f"-metadata:s:s:{i}", f"language={language}"]
+        return inputs + maps + metadata
+
+    def mux(self, settings:SettingsManager, progress:Progress=None) -> None:
+        unverified = self.manifest.unverified(self.segment_file)
+        if unverified:
+            raise SegmentError(f"Refusing to mux Lesson{self.h_index[0]}.{self.h_index[1]}, {len(unverified)} segments are missing or changed")
+        self.wait_captions()
+
+        segments_list = self.write_concat_list("segments.txt", range(self.video_count))
+
+        # Merge into single file
+        output = self.partial_output()
+        try:
+            with settings.metrics.stage("mux") as timer:
+                settings.muxer.run(['-f', 'concat', '-i', segments_list, *self.mux_args(), '-acodec', 'copy', '-vcodec', 'copy', '-f', 'matroska', output],
+                                   progress=progress,
+                                   description=f"Muxing Lesson{self.h_index[0]}.{self.h_index[1]}",
+                                   duration=self.stream_duration)
+                timer.bytes = os.path.getsize(output)
+        except BaseException:
+            self.remove_partial_output()
+            raise
+        os.replace(output, self.download_location)
+
+    def stream_mux(self, settings:SettingsManager, executor:concurrent.futures.Executor, progress:Progress) -> None:
+        # ffmpeg reads the video from its stdin only, a separate audio
+        # rendition has to be on disk before it starts
+        if self.audio_indices():
+            self.fetch_segments(settings, executor, progress, self.audio_indices())
+
+        segment_count = self.video_count
+        task = progress.add_task(f"[red]Lesson{self.h_index[0]}.{self.h_index[1]}", total=segment_count)
+
+        # Segments are piped into ffmpeg in playlist order as they arrive and
+        # never touch the disk. Only pipe_buffer bytes of segments ahead of
+        # the one being written are in flight, which bounds the memory held
+        # whatever the segment size.
+        # A piped ffmpeg mostly waits on the network, so it does not take
+        # one of the mux pool slots.
+        self.wait_captions()
+        output = self.partial_output()
+        job = settings.muxer.start(['-f', 'mpegts', '-i', 'pipe:0', *self.mux_args(), '-acodec', 'copy', '-vcodec', 'copy', '-f', 'matroska', output],
+                                   stdin=True)
+
+        futures:dict[int, concurrent.futures.Future] = {}
+        estimates:dict[int, int] = {}
+        submitted = 0
+        received = 0
+        try:
+            try:
+                for index in range(segment_count):
+                    average = received // index if index else 0
+                    # The segment being written is always fetched, even if it alone exceeds the buffer
+                    while submitted < segment_count:
+                        estimate = self.estimate_size(submitted, average) or settings.download_pipe_buffer
+                        if submitted > index and sum(estimates.values()) + estimate > settings.download_pipe_buffer:
+                            break
+                        futures[submitted] = self.submit_fetch(settings, executor, submitted)
+                        estimates[submitted] = estimate
+                        submitted += 1
+
+                    data = futures.pop(index).result()
+                    del estimates[index]
+                    received += len(data)
+                    job.stdin.write(data)
+                    progress.update(task, advance=1)
+            finally:
+                progress.remove_task(task)
+
+            # Segment fetches are counted on their own, this is what ffmpeg adds after the last one
+            with settings.metrics.stage("mux") as timer:
+                job.wait()
+                timer.bytes = os.path.getsize(output)
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            job.kill()
+            self.remove_partial_output()
+            raise
+
+        os.replace(output, self.download_location)
+        logger.debug(f"Streamed {segment_count} segments for Lesson{self.h_index[0]}.{self.h_index[1]} {self.title}")
+
+    def download_image(self, settings:SettingsManager, url:str, location:str) -> str:
+        if os.path.exists(location):
+            return location
+
+        with settings.metrics.stage("image_fetch") as timer:
+            response = settings.http.get(url)
+            response.raise_for_status()
+            timer.bytes = len(response.content)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location+'.part', 'wb') as f:
+            f.write(response.content)
+        os.replace(location+'.part', location)
+        return location
+
+    def save_article(self, settings:SettingsManager, driver:webdriver, executor:concurrent.futures.Executor=None) -> None:
+        lesson_body = fetch_article_body(self.asset_id, self.id, self.course.id, driver, settings)
+        body = lesson_body['body']
+
+        if settings.download_article_format == "markdown":
+            if executor is None:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=settings.segment_workers) as executor:
+                    body = self.article_markdown(settings, body, executor)
+            else:
+                body = self.article_markdown(settings, body, executor)
+
+        with open(self.download_location+'.part', 'w', encoding='utf-8') as f:
+            f.write(body)
+        os.replace(self.download_location+'.part', self.download_location)
+
+    def article_markdown(self, settings:SettingsManager, body:str, executor:concurrent.futures.Executor) -> str:
+        # Images go next to the article, named after their position in it
+        images_dir = article_files(self.download_location)
+        images:dict[str, tuple[str, concurrent.futures.Future]] = {}
+
+        def image_location(src:str) -> str:
+            if not settings.download_article_images or urlsplit(src).scheme not in ('http', 'https'):
+                return src
+            if src not in images:
+                file_name = f"{len(images) + 1:03d}_{os.path.basename(urlsplit(src).path) or 'image'}"
+                local = f"{os.path.basename(images_dir)}/{file_name}"
+                # Starts downloading while the rest of the article is converted
+                images[src] = (local, executor.submit(self.download_image, settings, src, os.path.join(images_dir, file_name)))
+            return images[src][0]
+
+        markdown = html_to_markdown(body, image_location)
+
+        for src, (local, future) in images.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Could not download image {src} of Lesson{self.h_index[0]}.{self.h_index[1]}: {e}")
+                markdown = markdown.replace(f"]({local})", f"]({src})")
+        if images:
+            logger.debug(f"Saved {len(images)} images of Lesson{self.h_index[0]}.{self.h_index[1]} to {images_dir}")
+        return markdown
@@ -0,0 +1,74 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# Tokens may go negative: every caller reserves what it needs and is told how
+# long to wait, so later callers queue behind earlier ones in arrival order.
+# Concurrent downloads are served alternately instead of one starving the rest.
+class TokenBucket():
+    def __init__(self, rate:float, burst:float=None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount:float=1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def consume(self, amount:float=1) -> None:
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# A global byte budget plus a request budget per host, shared by everything
+# that downloads. A rate of 0 disables that limit.
+class RateLimiter():
+    def __init__(self, bytes_per_second:float=0, requests_per_second:float=0) -> None:
+        self.bytes_per_second = bytes_per_second
+        self.requests_per_second = requests_per_second
+
+        # One second worth of bytes may burst, requests go out one at a time
+        self._bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self._hosts:dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.bytes_per_second or self.requests_per_second)
+
+    def _host_bucket(self, url:str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        with self._lock:
+            bucket = self._hosts.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.requests_per_second, burst=1)
+                self._hosts[host] = bucket
+        return bucket
+
+    def request_delay(self, url:str) -> float:
+        if not self.requests_per_second:
+            return 0.0
+        return self._host_bucket(url).reserve()
+
+    def bytes_delay(self, size:int) -> float:
+        if self._bytes is None or not size:
+            return 0.0
+        return self._bytes.reserve(size)
+
+    def wait_request(self, url:str) -> None:
+        delay = self.request_delay(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait_bytes(self, size:int) -> None:
+        delay = self.bytes_delay(size)
+        if delay > 0:
+            time.sleep(delay)
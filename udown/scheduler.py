@@ -0,0 +1,206 @@
+import concurrent.futures
+import os
+import threading
+import time
+import undetected_chromedriver as webdriver
+from loguru import logger
+
+from rich.progress import Progress
+
+from settings import SettingsManager
+from objects import Course, Lesson, LessonType
+from jobqueue import JobQueue, JobState
+from snapshot import CurriculumSnapshot
+
+
+class CourseScheduler():
+    def __init__(self, course:Course, settings:SettingsManager, driver:webdriver, queue:JobQueue=None, workers:int=None) -> None:
+        self.course = course
+        self.settings = settings
+        self.driver = driver
+        self.queue = queue
+        self.workers = workers or settings.download_parallel_lessons
+
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.downloaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def courses(self) -> list[Course]:
+        return [self.course]
+
+    def lessons(self) -> list[Lesson]:
+        lessons = []
+        for section in self.course.content:
+            lessons.extend(section['lessons'])
+        return lessons
+
+    def run(self) -> None:
+        lessons = self.lessons()
+        if self.settings.async_engine is not None:
+            logger.info(f"Scheduling {len(lessons)} lessons ({self.workers} in parallel, up to {self.settings.async_engine.max_connections} async connections)")
+        else:
+            logger.info(f"Scheduling {len(lessons)} lessons ({self.workers} in parallel, {self.settings.download_threads} segment threads)")
+        if self.settings.concurrency is not None:
+            logger.info(f"Segment threads adapt between {self.settings.concurrency.minimum} and {self.settings.concurrency.maximum}")
+
+        started = time.monotonic()
+        # Segment downloads from every lesson share one pool, which is the
+        # global network budget. Lesson workers only drive the download
+        # stages and hand finished lessons to the mux pool, so a merge never
+        # holds a lesson slot.
+        with Progress() as progress, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.segment_workers) as segment_executor, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as lesson_executor, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.download_mux_jobs) as mux_executor:
+
+            # Holds the download future of a lesson and then its mux future
+            pending = {lesson_executor.submit(self.process, lesson, segment_executor, mux_executor, progress): lesson
+                       for lesson in lessons}
+
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    lesson = pending.pop(future)
+                    try:
+                        mux_future = future.result()
+                    except Exception as e:
+                        logger.error(f"Could not download Lesson{lesson.h_index[0]}.{lesson.h_index[1]} {lesson.title}: {e}")
+                        with self._lock:
+                            self.failed += 1
+                        if self.queue is not None:
+                            self.queue.set_lesson_state(lesson.course.id, lesson.id, JobState.FAILED, error=str(e))
+                        continue
+                    if mux_future is not None:
+                        pending[mux_future] = lesson
+
+        if self.settings.concurrency is not None:
+            logger.info(f"Segment concurrency converged at {self.settings.concurrency.limit} (peak {self.settings.concurrency.peak}, {self.settings.concurrency.adjustments} adjustments)")
+        self.summary(time.monotonic() - started)
+        self.write_metrics()
+
+    def summary(self, elapsed:float) -> None:
+        rate = self.downloaded_bytes / elapsed if elapsed else 0
+        logger.info(f"Downloaded {self.downloaded} lessons ({self.downloaded_bytes / 2**20:.1f} MiB) in {elapsed:.0f}s at {rate / 2**20:.2f} MiB/s, "
+                    f"{self.skipped} already present, {self.failed} failed")
+
+        for stage, counts in self.settings.metrics.report()['stages'].items():
+            logger.debug(f"{stage}: {counts['calls']} calls, {counts['seconds']:.1f}s, {counts['bytes'] / 2**20:.1f} MiB, {counts['errors']} errors, {counts['retries']} retries")
+
+    def write_metrics(self) -> None:
+        if not (self.settings.metrics_report_file or self.settings.metrics_prometheus_file):
+            return
+
+        report = self.settings.metrics.report(self.settings.cache.stats(),
+                                              courses=[course.id for course in self.courses()],
+                                              lessons={"downloaded": self.downloaded, "skipped": self.skipped, "failed": self.failed},
+                                              downloaded_bytes=self.downloaded_bytes)
+        if self.settings.metrics_report_file:
+            self.settings.metrics.write_jsonl(self.settings.metrics_report_file, report)
+        if self.settings.metrics_prometheus_file:
+            self.settings.metrics.write_prometheus(self.settings.metrics_prometheus_file, report)
+        logger.debug("Wrote run metrics")
+
+    def process(self, lesson:Lesson, segment_executor:concurrent.futures.Executor, mux_executor:concurrent.futures.Executor, progress:Progress) -> concurrent.futures.Future | None:
+        logger.debug(f"Download {lesson.title}")
+        if self.queue is not None:
+            self.queue.set_lesson_state(lesson.course.id, lesson.id, JobState.RUNNING)
+
+        if not lesson.prepare(self.settings, self.driver):
+            # Either already downloaded or claimed by another process
+            if os.path.exists(lesson.download_location):
+                with self._lock:
+                    self.skipped += 1
+                if self.queue is not None:
+                    self.queue.set_lesson_state(lesson.course.id, lesson.id, JobState.DONE, size=os.path.getsize(lesson.download_location))
+            elif self.queue is not None:
+                self.queue.set_lesson_state(lesson.course.id, lesson.id, JobState.PENDING)
+            return
+
+        if lesson.lesson_type == LessonType.VIDEO and self.settings.download_mux_mode == "pipe":
+            success = False
+            try:
+                lesson.fetch_captions(self.settings, segment_executor)
+                lesson.stream_mux(self.settings, segment_executor, progress)
+                success = True
+            finally:
+                lesson.release_work_dir(self.settings, success)
+
+        elif lesson.lesson_type == LessonType.VIDEO:
+            try:
+                lesson.fetch_captions(self.settings, segment_executor)
+                lesson.fetch_segments(self.settings, segment_executor, progress)
+            except BaseException:
+                lesson.release_work_dir(self.settings, False)
+                raise
+            return mux_executor.submit(self.merge, lesson, progress)
+
+        elif lesson.lesson_type == LessonType.ARTICLE:
+            lesson.save_article(self.settings, self.driver, segment_executor)
+
+        self.complete(lesson)
+        return None
+
+    def merge(self, lesson:Lesson, progress:Progress) -> None:
+        success = False
+        try:
+            lesson.mux(self.settings, progress)
+            success = True
+        finally:
+            lesson.release_work_dir(self.settings, success)
+        self.complete(lesson)
+
+    def complete(self, lesson:Lesson) -> None:
+        size = os.path.getsize(lesson.download_location)
+        with self._lock:
+            self.downloaded += 1
+            self.downloaded_bytes += size
+        if self.queue is not None:
+            self.queue.set_lesson_state(lesson.course.id, lesson.id, JobState.DONE, size=size)
+        logger.success(f"Downloaded Lesson{lesson.h_index[0]}.{lesson.h_index[1]} {lesson.title}")
+
+
+# Runs the lessons of every queued course through one set of pools, so the
+# segment budget and the lesson worker count hold across courses.
+class BatchScheduler(CourseScheduler):
+    def __init__(self, courses:list[Course], settings:SettingsManager, driver:webdriver, queue:JobQueue, workers:int=None) -> None:
+        super().__init__(None, settings, driver, queue, workers)
+        self.batch = courses
+
+    def courses(self) -> list[Course]:
+        return self.batch
+
+    def lessons(self) -> list[Lesson]:
+        lessons = []
+        for course in self.batch:
+            for section in course.content:
+                lessons.extend(lesson for lesson in section['lessons']
+                               if self.queue.lesson_state(course.id, lesson.id) != JobState.DONE)
+        return lessons
+
+    def run(self) -> None:
+        try:
+            super().run()
+        finally:
+            # Also writes the lesson states that were not saved yet
+            self.queue.finish_courses()
+
+
+# Only downloads the lessons a sync found added or changed, and records the
+# curriculum afterwards so the next sync compares against this run.
+class SyncScheduler(CourseScheduler):
+    def __init__(self, course:Course, settings:SettingsManager, driver:webdriver, snapshot:CurriculumSnapshot, lessons:list[Lesson], workers:int=None) -> None:
+        super().__init__(course, settings, driver, workers=workers)
+        self.snapshot = snapshot
+        self.planned = lessons
+
+    def lessons(self) -> list[Lesson]:
+        return self.planned
+
+    def run(self) -> None:
+        try:
+            super().run()
+        finally:
+            self.snapshot.update(super().lessons(), self.settings)
+            self.snapshot.save()
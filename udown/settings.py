@@ -1,7 +1,19 @@
 import json
 from loguru import logger
-from utils import ExtendedEnum
+from utils import ExtendedEnum, get_url_expiry, slugify
+from transport import SessionPool
+from muxer import MuxPool
+from async_engine import AsyncSegmentEngine
+from concurrency import AdaptiveLimiter
+from ratelimit import RateLimiter
+from captions import CaptionCache
+from metrics import Metrics
+from cache import CacheBackend, JsonFileBackend, SqliteBackend, MemoryCache
+import atexit
 import os
+import threading
+import time
+from collections import Counter
 from enum import Enum
 
 
@@ -25,8 +37,16 @@ class CacheManager():
     cache_settings:list[CacheSetting] = []
     directory = ".ud_cache"
 
-    def __init__(self, directory:str, settings:dict) -> None:
+    def __init__(self, directory:str, settings:dict, backend:str="json", max_size:int=0, eviction_interval:int=600, refresh_margin:int=900, memory_entries:int=1024) -> None:
         self.directory = directory
+        self.cache_settings = []
+        self.memory = MemoryCache(memory_entries)
+        self.hits = Counter()
+        self.misses = Counter()
+        self._stats_lock = threading.Lock()
+        self.max_size = max_size
+        self.eviction_interval = eviction_interval
+        self.refresh_margin = refresh_margin
 
         try:
             os.mkdir(self.directory)
@@ -50,23 +70,112 @@ class CacheManager():
             except KeyError as k:
                 logger.error(f"Settings file is missing cache paramter: {k}")
                 quit()
-        
+
+        match backend:
+            case "json":
+                self.backend:CacheBackend = JsonFileBackend(self.directory)
+            case "sqlite":
+                self.backend:CacheBackend = SqliteBackend(self.directory)
+            case _:
+                logger.error(f"Unknown cache backend {backend}")
+                quit()
+        logger.debug(f"Using {backend} cache backend")
+
+        self._stop_eviction = threading.Event()
+        self._eviction_thread = threading.Thread(target=self._evict_periodically, daemon=True)
+        self._eviction_thread.start()
+        atexit.register(self.close)
     
     def get(self, role:CacheRole) -> CacheSetting:
         for cache_setting in self.cache_settings:
             if cache_setting.role == role:
                 return cache_setting
     
-    def location(self, role:CacheRole, id:int=None) -> str:
-        if id is None: id = ""
-        return os.path.join(self.directory, role.name, str(id))
-
-    def delete(self, role:CacheRole, id:int):
-        location = self.location(role, id)
-        if os.path.exists(location):
-            os.remove(location)
-        else:
-            logger.warning(f"Tried to delete cache file at {location} does not exist.")
+    def is_valid(self, role:CacheRole, content:dict) -> bool:
+        if role != CacheRole.lessonStreams:
+            return True
+
+        # Stream and caption urls are signed, refresh them before they lapse
+        asset = content.get('asset') or {}
+        urls = [x.get('src', "") for x in asset.get('media_sources') or []] + \
+               [x.get('url', "") for x in asset.get('captions') or []]
+        expiries = [x for x in map(get_url_expiry, urls) if x is not None]
+        return not expiries or min(expiries) - time.time() > self.refresh_margin
+
+    def read(self, role:CacheRole, id:int) -> dict | None:
+        return self.read_many(role, [id]).get(str(id))
+
+    def read_many(self, role:CacheRole, ids:list[int]) -> dict[str, dict]:
+        max_age = self.get(role).expire
+        entries = {}
+        missing = []
+        for id in map(str, ids):
+            entry = self.memory.get(role.name, id, max_age)
+            if entry is None:
+                missing.append(id)
+            else:
+                entries[id] = entry
+
+        if missing:
+            for id, entry in self.backend.read_entries(role.name, missing, max_age).items():
+                self.memory.put(role.name, id, *entry)
+                entries[id] = entry
+
+        found = {}
+        for id, (content, _) in entries.items():
+            if self.is_valid(role, content):
+                found[id] = content
+            else:
+                logger.debug(f"Signed urls in {role.name}:{id} are about to expire")
+                self.memory.discard(role.name, id)
+
+        with self._stats_lock:
+            self.hits[role.name] += len(found)
+            self.misses[role.name] += len(ids) - len(found)
+        return found
+
+    def write(self, role:CacheRole, id:int, content:dict) -> None:
+        self.backend.write(role.name, str(id), content)
+        self.memory.put(role.name, str(id), content)
+
+    def write_many(self, role:CacheRole, items:dict[int, dict]) -> None:
+        self.backend.write_many(role.name, {str(id): content for id, content in items.items()})
+        for id, content in items.items():
+            self.memory.put(role.name, str(id), content)
+
+    def delete(self, role:CacheRole, id:int, missing_ok:bool=False):
+        self.memory.discard(role.name, str(id))
+        if not self.backend.delete(role.name, str(id)) and not missing_ok:
+            logger.warning(f"Tried to delete cache entry {role.name}:{id} which does not exist.")
+
+    def stats(self) -> dict[str, dict]:
+        return {role: {"hits": self.hits[role], "misses": self.misses[role],
+                       "memory_hits": self.memory.hits[role], "memory_misses": self.memory.misses[role]}
+                for role in CacheRole.list()}
+
+    def evict(self) -> int:
+        removed = self.backend.evict(self.max_size, {x.role.name: x.expire for x in self.cache_settings})
+        if removed:
+            # Evicted entries may still be held in memory
+            self.memory.clear()
+            logger.debug(f"Evicted {removed} cache entries")
+        return removed
+
+    def _evict_periodically(self) -> None:
+        while not self._stop_eviction.is_set():
+            try:
+                self.evict()
+            except Exception as e:
+                logger.warning(f"Cache eviction failed: {e}")
+            self._stop_eviction.wait(self.eviction_interval)
+
+    def close(self) -> None:
+        self._stop_eviction.set()
+        self._eviction_thread.join()
+        self.backend.close()
+        for role, counts in self.stats().items():
+            if counts['hits'] or counts['misses']:
+                logger.debug(f"Cache {role}: {counts['hits']} hits, {counts['misses']} misses ({counts['memory_hits']} from memory)")
         
 
 class CredentialsObject():
@@ -111,6 +220,17 @@ class SeleniumSettings():
     def __init__(self, webdriver_path:str="chrome/chromedriver.exe", browser_path:str="chrome/chrome.exe", headless:bool=False) -> None:
         self.webdriver_path = webdriver_path
         self.browser_path = browser_path
+        self.headless = headless
+
+
+class NetworkSettings():
+    def __init__(self, timeout:tuple[float]=(10, 30), retries:int=3, backoff:float=0.5, pool_size:int=None, bytes_per_second:float=0, requests_per_second:float=0) -> None:
+        self.timeout = tuple(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.bytes_per_second = bytes_per_second
+        self.requests_per_second = requests_per_second
 
 
 class CookieProcessType(Enum):
@@ -125,9 +245,43 @@ class SettingsManager():
     cookies = []
 
     download_video_resolution = "max"
+    download_max_bandwidth = 0
     download_location = "downloads/$course-slug/$section-slug/$lesson-slug"
     download_captions = True
+    download_caption_locales = []
+    download_article_format = "markdown"
+    download_article_images = True
     download_threads = 4
+    download_adaptive_threads = True
+    download_min_threads = 1
+    download_max_threads = 16
+    segment_workers = 4
+    concurrency = None
+    download_chunk_size = 65536
+    download_coalesce_size = 2097152
+    download_segment_retries = 3
+    download_segment_backoff = 1.0
+    download_verify_segments = True
+    download_parallel_lessons = 2
+    download_mux_jobs = 1
+    download_work_directory = ".ud_work"
+    download_cleanup = "on_success"
+    download_mux_mode = "concat"
+    download_pipe_buffer = 67108864
+    ffmpeg_path = "ffmpeg"
+    download_prefetch = True
+    download_prefetch_concurrency = 8
+    download_engine = "threads"
+    async_engine = None
+    batch_queue_file = ".ud_queue.json"
+    sync_directory = ".ud_sync"
+    sync_stale = "keep"
+    metrics_report_file = None
+    metrics_prometheus_file = None
+    api_transport = "browser"
+    api_client = None
+    api_user_agent = None
+    api_base_url = "https://www.udemy.com"
 
     def __init__(self) -> None:
         self.load()
@@ -136,6 +290,7 @@ class SettingsManager():
         if settings_file is None:
             settings_file = self.settings_file
         logger.info(f"Using settings file {settings_file}")
+        self.metrics = Metrics()
 
         try:
             with open(settings_file, "r") as f:
@@ -155,20 +310,117 @@ class SettingsManager():
             self.selenium = SeleniumSettings(
                 webdriver_path=settings_dict["selenium"]["webdriver_path"],
                 browser_path=settings_dict["selenium"]["browser_path"],
+                headless=settings_dict["selenium"].get("headless", False),
             )
 
             self.download_video_resolution = settings_dict['downloads']['video_resolution']
+            self.download_max_bandwidth = settings_dict['downloads'].get('max_bandwidth', self.download_max_bandwidth)
             self.location = settings_dict['downloads']['location']
             self.download_threads = settings_dict['downloads']['threads']
+            self.download_adaptive_threads = settings_dict['downloads'].get('adaptive_threads', self.download_adaptive_threads)
+            self.download_min_threads = settings_dict['downloads'].get('min_threads', self.download_min_threads)
+            self.download_max_threads = settings_dict['downloads'].get('max_threads', self.download_max_threads)
+
+            # With adaptive threads the pool is sized for the upper bound and
+            # the limiter decides how many of its workers may fetch at once,
+            # starting from `threads`
+            self.segment_workers = self.download_threads
+            if self.download_adaptive_threads:
+                self.concurrency = AdaptiveLimiter(minimum=self.download_min_threads,
+                                                   maximum=self.download_max_threads,
+                                                   initial=self.download_threads)
+                self.segment_workers = self.concurrency.maximum
             self.download_captions = settings_dict['downloads']['captions']
+            self.download_caption_locales = settings_dict['downloads'].get('caption_locales', self.download_caption_locales)
+            self.download_article_format = settings_dict['downloads'].get('article_format', self.download_article_format)
+            self.download_article_images = settings_dict['downloads'].get('article_images', self.download_article_images)
+            self.download_chunk_size = settings_dict['downloads'].get('chunk_size', self.download_chunk_size)
+            self.download_coalesce_size = settings_dict['downloads'].get('coalesce_size', self.download_coalesce_size)
+            self.download_segment_retries = settings_dict['downloads'].get('segment_retries', self.download_segment_retries)
+            self.download_segment_backoff = settings_dict['downloads'].get('segment_backoff', self.download_segment_backoff)
+            self.download_verify_segments = settings_dict['downloads'].get('verify_segments', self.download_verify_segments)
+            self.download_parallel_lessons = settings_dict['downloads'].get('parallel_lessons', self.download_parallel_lessons)
+            self.download_mux_jobs = settings_dict['downloads'].get('mux_jobs', self.download_mux_jobs)
+            self.download_work_directory = settings_dict['downloads'].get('work_directory', self.download_work_directory)
+            self.download_cleanup = settings_dict['downloads'].get('cleanup', self.download_cleanup)
+            self.download_mux_mode = settings_dict['downloads'].get('mux_mode', self.download_mux_mode)
+            self.download_pipe_buffer = settings_dict['downloads'].get('pipe_buffer', self.download_pipe_buffer)
+            self.ffmpeg_path = settings_dict['downloads'].get('ffmpeg_path', self.ffmpeg_path)
+            self.download_prefetch = settings_dict['downloads'].get('prefetch', self.download_prefetch)
+            self.download_prefetch_concurrency = settings_dict['downloads'].get('prefetch_concurrency', self.download_prefetch_concurrency)
+            self.batch_queue_file = settings_dict.get('batch', {}).get('queue_file', self.batch_queue_file)
+            self.sync_directory = settings_dict.get('sync', {}).get('directory', self.sync_directory)
+            self.sync_stale = settings_dict.get('sync', {}).get('stale', self.sync_stale)
+            self.metrics_report_file = settings_dict.get('metrics', {}).get('report_file', self.metrics_report_file)
+            self.metrics_prometheus_file = settings_dict.get('metrics', {}).get('prometheus_file', self.metrics_prometheus_file)
+            self.api_transport = settings_dict.get('api', {}).get('transport', self.api_transport)
+            self.api_user_agent = settings_dict.get('api', {}).get('user_agent')
+            self.api_base_url = settings_dict.get('api', {}).get('base_url', self.api_base_url)
             self.download_location = settings_dict['downloads']['location']
 
+            _network = settings_dict.get('network', {})
+            self.network = NetworkSettings(
+                timeout=_network.get('timeout', (10, 30)),
+                retries=_network.get('retries', 3),
+                backoff=_network.get('backoff', 0.5),
+                pool_size=_network.get('pool_size') or self.segment_workers,
+                bytes_per_second=_network.get('bytes_per_second') or 0,
+                requests_per_second=_network.get('requests_per_second') or 0,
+            )
+            # One limiter for every downloader so the budget holds across lessons
+            self.rate_limiter = RateLimiter(bytes_per_second=self.network.bytes_per_second,
+                                            requests_per_second=self.network.requests_per_second)
+            self.http = SessionPool(pool_size=self.network.pool_size,
+                                    timeout=self.network.timeout,
+                                    retries=self.network.retries,
+                                    backoff=self.network.backoff,
+                                    limiter=self.rate_limiter)
+            # Segments are retried by with_retries, which counts and backs off
+            # every attempt. Retrying inside the adapter as well would multiply
+            # the requests for a dead segment.
+            self.segment_http = SessionPool(pool_size=self.network.pool_size,
+                                            timeout=self.network.timeout,
+                                            retries=0,
+                                            limiter=self.rate_limiter)
+            self.muxer = MuxPool(max_jobs=self.download_mux_jobs, ffmpeg_path=self.ffmpeg_path)
+
+            self.download_engine = settings_dict['downloads'].get('engine', self.download_engine)
+            if self.download_engine == "asyncio":
+                try:
+                    self.async_engine = AsyncSegmentEngine(max_connections=settings_dict['downloads'].get('async_connections', 200),
+                                                           per_host=settings_dict['downloads'].get('async_per_host', 50),
+                                                           timeout=self.network.timeout,
+                                                           chunk_size=self.download_chunk_size,
+                                                           limiter=self.rate_limiter,
+                                                           segment_retries=self.download_segment_retries,
+                                                           segment_backoff=self.download_segment_backoff,
+                                                           verify=self.download_verify_segments,
+                                                           metrics=self.metrics)
+                except ImportError as e:
+                    logger.error(e)
+                    logger.warning("Falling back to the threaded download engine")
+                    self.download_engine = "threads"
+                else:
+                    atexit.register(self.async_engine.close)
+                    # The engine bounds its own connections, segments never
+                    # go through the thread limiter
+                    self.concurrency = None
+                    self.segment_workers = self.download_threads
+
+
             _fi = settings_dict['xhr_headers']
             with open(_fi, 'r') as f:
                 self.xhr_headers = f.read()
 
             
-            self.cache = CacheManager(settings_dict['cache']['directory'], settings_dict['cache']['settings'])
+            self.cache = CacheManager(settings_dict['cache']['directory'], 
+                                      settings_dict['cache']['settings'], 
+                                      backend=settings_dict['cache'].get('backend', "json"),
+                                      max_size=settings_dict['cache'].get('max_size', 0),
+                                      eviction_interval=settings_dict['cache'].get('eviction_interval', 600),
+                                      refresh_margin=settings_dict['cache'].get('refresh_margin', 900),
+                                      memory_entries=settings_dict['cache'].get('memory_entries', 1024))
+            self.captions = CaptionCache(os.path.join(self.cache.directory, "captions"), self.http, self.metrics)
         except KeyError as e:
             logger.error(f"Settings file is missing {e} parameter..")            
             quit()
@@ -186,3 +438,10 @@ def parse_cookies(cookies_path:str) -> tuple[dict]:
         quit()
     
     return cookies
+
+
+def email_from_cookies(cookies:tuple[dict]) -> str | None:
+    for cookie in cookies:
+        if cookie['name'] == "ud_last_auth_information":
+            return slugify(cookie['value']).split("-user-email-")[-1].split('-suggested-')[0]
+    return None
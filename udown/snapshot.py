@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import time
+from enum import Enum
+from loguru import logger
+
+from settings import SettingsManager, CacheRole
+
+
+class LessonChange(Enum):
+    ADDED = "added"
+    CHANGED = "changed"
+    RENAMED = "renamed"
+    UNCHANGED = "unchanged"
+    REMOVED = "removed"
+
+
+# The curriculum of a course as it was when it was last synced, keyed by
+# lecture id. Comparing it with the current curriculum tells which lectures
+# are new, which got a different asset, which only moved or got renamed and
+# which are gone, so a sync only downloads what actually changed.
+class CurriculumSnapshot():
+    def __init__(self, location:str) -> None:
+        self.location = location
+        self.lessons:dict[str, dict] = {}
+        self.taken = None
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.location, 'r') as f:
+                content = json.loads(f.read())
+        except FileNotFoundError:
+            self.lessons = {}
+            return
+        except json.decoder.JSONDecodeError:
+            logger.error(f"Could not parse curriculum snapshot at {self.location}")
+            quit()
+        self.lessons = content.get('lessons', {})
+        self.taken = content.get('taken')
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.location) or ".", exist_ok=True)
+        content = json.dumps({"taken": self.taken, "lessons": self.lessons}, indent=1)
+        with open(self.location+'.tmp', 'w') as f:
+            f.write(content)
+        os.replace(self.location+'.tmp', self.location)
+
+    def entry(self, lesson, settings:SettingsManager) -> dict:
+        return {"asset_id": lesson.asset_id,
+                "asset_type": lesson.lesson_type.value,
+                "title": lesson.title,
+                "location": lesson.resolve_download_location(settings)}
+
+    def diff(self, lessons:list, settings:SettingsManager) -> dict[LessonChange, list]:
+        changes:dict[LessonChange, list] = {kind: [] for kind in LessonChange}
+        current = set()
+        for lesson in lessons:
+            current.add(str(lesson.id))
+            stored = self.lessons.get(str(lesson.id))
+            entry = self.entry(lesson, settings)
+
+            if stored is None or not os.path.exists(stored['location']):
+                # Outputs from before the first sync are adopted as they are
+                kind = LessonChange.UNCHANGED if os.path.exists(entry['location']) else LessonChange.ADDED
+            elif stored['asset_id'] != entry['asset_id'] or stored['asset_type'] != entry['asset_type']:
+                kind = LessonChange.CHANGED
+            elif os.path.splitext(stored['location'])[1] != os.path.splitext(entry['location'])[1]:
+                # Another article format needs a new download, moving the old file would keep its content
+                kind = LessonChange.CHANGED
+            elif os.path.splitext(stored['location'])[0] != os.path.splitext(entry['location'])[0]:
+                kind = LessonChange.RENAMED
+            else:
+                kind = LessonChange.UNCHANGED
+            changes[kind].append((lesson, stored))
+
+        changes[LessonChange.REMOVED] = [(None, stored) for id, stored in self.lessons.items() if id not in current]
+        return changes
+
+    def apply(self, course, lessons:list, settings:SettingsManager) -> list:
+        changes = self.diff(lessons, settings)
+        logger.info(f"Sync of {course.title}: " + ", ".join(f"{len(items)} {kind.value}" for kind, items in changes.items()))
+
+        # Renamed outputs are parked under a temporary name first, so lessons
+        # that swapped names do not overwrite each other
+        moves = []
+        for lesson, stored in changes[LessonChange.RENAMED]:
+            parked = f"{stored['location']}.sync-{lesson.id}"
+            os.replace(stored['location'], parked)
+            moves.append((lesson, stored['location'], parked))
+        for lesson, old_location, parked in moves:
+            location = lesson.resolve_download_location(settings)
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            os.replace(parked, location)
+            move_article_files(old_location, location)
+            logger.debug(f"Moved {old_location} to {location}")
+
+        for lesson, stored in changes[LessonChange.CHANGED]:
+            remove_output(stored['location'])
+            # Cached stream urls and bodies belong to the old asset
+            settings.cache.delete(CacheRole.lessonStreams, str(course.id)+str(lesson.id), missing_ok=True)
+            settings.cache.delete(CacheRole.articleBody, str(course.id)+str(lesson.id), missing_ok=True)
+            logger.debug(f"Removed {stored['location']}, its asset changed")
+
+        for _, stored in changes[LessonChange.REMOVED]:
+            if not os.path.exists(stored['location']):
+                continue
+            if settings.sync_stale == "delete":
+                remove_output(stored['location'])
+                logger.info(f"Removed {stored['location']}, it is no longer part of the course")
+            else:
+                logger.info(f"{stored['location']} is no longer part of the course")
+
+        return [lesson for lesson, _ in changes[LessonChange.ADDED] + changes[LessonChange.CHANGED]]
+
+    def update(self, lessons:list, settings:SettingsManager) -> None:
+        # Lessons without an output are left out, the next sync downloads them again
+        self.lessons = {}
+        for lesson in lessons:
+            entry = self.entry(lesson, settings)
+            if os.path.exists(entry['location']):
+                self.lessons[str(lesson.id)] = entry
+        self.taken = time.time()
+
+
+def article_files(location:str) -> str:
+    return os.path.splitext(location)[0] + "_files"
+
+
+def move_article_files(old_location:str, location:str) -> None:
+    # Markdown articles link their images relative to themselves
+    if not os.path.isdir(article_files(old_location)):
+        return
+    shutil.move(article_files(old_location), article_files(location))
+
+    old_link = f"]({os.path.basename(article_files(old_location))}/"
+    new_link = f"]({os.path.basename(article_files(location))}/"
+    with open(location, 'r', encoding='utf-8') as f:
+        content = f.read()
+    with open(location+'.part', 'w', encoding='utf-8') as f:
+        f.write(content.replace(old_link, new_link))
+    os.replace(location+'.part', location)
+
+
+def remove_output(location:str) -> None:
+    try:
+        os.remove(location)
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(article_files(location), ignore_errors=True)
@@ -0,0 +1,72 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from loguru import logger
+
+from ratelimit import RateLimiter
+
+
+# One keep-alive session per host, shared by every download thread
+class SessionPool():
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size:int=4, timeout:tuple[float]=(10, 30), retries:int=3, backoff:float=0.5, limiter:RateLimiter=None) -> None:
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = limiter if limiter is not None and limiter.enabled else None
+
+        self._sessions:dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self) -> requests.Session:
+        retry = Retry(total=self.retries,
+                      backoff_factor=self.backoff,
+                      status_forcelist=self.retry_statuses,
+                      allowed_methods=frozenset(["GET", "HEAD"]),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session(self, url:str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._new_session()
+                self._sessions[host] = session
+                logger.debug(f"Opened HTTP session for {host} (pool size {self.pool_size})")
+        return session
+
+    def get(self, url:str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        if self.limiter is None:
+            return self.session(url).get(url, **kwargs)
+
+        self.limiter.wait_request(url)
+        response = self.session(url).get(url, **kwargs)
+        # Streamed bodies are accounted chunk by chunk in iter_content
+        if not kwargs.get('stream'):
+            self.limiter.wait_bytes(len(response.content))
+        return response
+
+    def iter_content(self, response:requests.Response, chunk_size:int=65536):
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if self.limiter is not None:
+                self.limiter.wait_bytes(len(chunk))
+            yield chunk
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
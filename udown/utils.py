@@ -3,8 +3,21 @@ from os import system, name
 import time
 import random
 from enum import Enum
-import requests
 import os
+import json
+import base64
+from urllib.parse import urlsplit, parse_qs
+import requests
+from loguru import logger
+
+from transport import SessionPool
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+
+class SegmentError(Exception):
+    pass
 
 class ExtendedEnum(Enum):
     @classmethod
@@ -41,33 +54,169 @@ def get_link_type(link:str) -> LinkType:
         return LinkType.LINK
 
 
+def get_url_expiry(url:str) -> int | None:
+    query = parse_qs(urlsplit(url).query)
+    # CloudFront signed urls
+    if 'Expires' in query:
+        try:
+            return int(query['Expires'][0])
+        except ValueError:
+            return None
+    # Udemy stream urls carry a JWT with an exp claim
+    if 'token' in query:
+        try:
+            payload = query['token'][0].split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return int(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (IndexError, KeyError, ValueError, TypeError):
+            return None
+    return None
+
+
 def clear_screen() -> None:
     if name == 'nt':
         _ = system('cls') 
     else:
         _ = system('clear')
 
+def try_lock(fd:int) -> bool:
+    # An advisory lock belongs to the open file, the OS drops it when the
+    # owning process exits however it dies
+    try:
+        if name == 'nt':
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
 def rand_input_delay(delay:int=None):
     if delay is None:
         time.sleep(delay)
         return
     time.sleep(random.randint(50,90)*0.01)
 
-def parse_m3u(url:str) -> list[str]:
-    response = requests.get(url)
-    ts_files = []
-    for line in response.text.split('\n'):
-        if not line.startswith('http'):
-            continue
-        if get_link_type(line) == LinkType.TS:
-            ts_files.append(line)
-    return ts_files
-
-def download_ts(link:str):
-    file_name = get_filename_from_link(link)
-    if os.path.exists(file_name+'.ts'):
-        return
+def is_valid_ts(data:bytes) -> bool:
+    # Every transport stream packet is 188 bytes and starts with the sync byte
+    if not data or len(data) % TS_PACKET_SIZE:
+        return False
+    return data[::TS_PACKET_SIZE].count(TS_SYNC_BYTE) == len(data) // TS_PACKET_SIZE
+
+class TsVerifier():
+    # Checks the sync byte of every packet as the chunks stream by, so a
+    # segment never has to be held or read back whole to be verified
+    def __init__(self) -> None:
+        self.position = 0
+        self.valid = True
+
+    def update(self, chunk:bytes) -> None:
+        if self.valid:
+            packets = chunk[-self.position % TS_PACKET_SIZE::TS_PACKET_SIZE]
+            self.valid = packets.count(TS_SYNC_BYTE) == len(packets)
+        self.position += len(chunk)
+
+    def update_from_file(self, file_path:str, chunk_size:int=65536) -> None:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                self.update(chunk)
+
+    def complete(self) -> bool:
+        return self.valid and self.position > 0 and self.position % TS_PACKET_SIZE == 0
+
+def expected_size(status_code:int, headers:dict) -> int | None:
+    # Decoded bodies do not match the length on the wire
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    if status_code == 206 and '/' in headers.get('Content-Range', ""):
+        total = headers['Content-Range'].rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+def with_retries(function, *args, retries:int=3, backoff:float=1.0, on_retry=None, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except (requests.RequestException, SegmentError) as e:
+            # Client errors such as an expired signature do not go away by asking again
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if attempt == retries or (status is not None and 400 <= status < 500 and status not in (408, 429)):
+                raise
+            # Jitter keeps segments that failed together from retrying together
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            retry_after = getattr(getattr(e, 'response', None), 'headers', {}).get('Retry-After', "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.warning(f"{e}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
+
+def range_header(byterange:tuple[int, int]=None, offset:int=0) -> dict[str, str]:
+    # byterange is (offset, length) of the segment inside the resource,
+    # offset is how much of the segment is already on disk
+    if byterange is None:
+        return {'Range': f"bytes={offset}-"} if offset else {}
+    start, length = byterange
+    return {'Range': f"bytes={start + offset}-{start + length - 1}"}
+
+def fetch_segment(link:str, http:SessionPool, verify:bool=True, byterange:tuple[int, int]=None) -> bytes:
+    response = http.get(link, headers=range_header(byterange))
+    response.raise_for_status()
+    if byterange is not None and response.status_code != 206:
+        raise SegmentError(f"Server ignored the byte range for {link}")
+    size = byterange[1] if byterange is not None else expected_size(response.status_code, response.headers)
+    if size is not None and len(response.content) != size:
+        raise SegmentError(f"Segment {link} is {len(response.content)} bytes, expected {size}")
+    if verify and not is_valid_ts(response.content):
+        raise SegmentError(f"Segment {link} is not a valid transport stream")
+    return response.content
+
+def download_ts(link:str, file_path:str, http:SessionPool, chunk_size:int=65536, verify:bool=True, byterange:tuple[int, int]=None) -> int:
+    if os.path.exists(file_path):
+        return os.path.getsize(file_path)
     
-    stream_content = requests.get(link)    
-    with open(file_name+'.ts', 'wb') as f:
-        f.write(stream_content.content)
\ No newline at end of file
+    # Stream into a partial file and only expose the complete segment,
+    # so the exists check above never trusts a truncated download.
+    # A partial file left by an earlier run is continued with a range request.
+    part_name = file_path+'.part'
+    offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+
+    with http.get(link, stream=True, headers=range_header(byterange, offset)) as stream_content:
+        if offset and stream_content.status_code == 416:
+            os.remove(part_name)
+            return download_ts(link, file_path, http, chunk_size, verify, byterange)
+        stream_content.raise_for_status()
+        if byterange is not None:
+            if stream_content.status_code != 206:
+                raise SegmentError(f"Server ignored the byte range for {link}")
+            size = byterange[1]
+        else:
+            if stream_content.status_code != 206:
+                offset = 0
+            size = expected_size(stream_content.status_code, stream_content.headers)
+
+        verifier = TsVerifier() if verify else None
+        if verifier is not None and offset:
+            verifier.update_from_file(part_name, chunk_size)
+
+        with open(part_name, 'ab' if offset else 'wb') as f:
+            for chunk in http.iter_content(stream_content, chunk_size):
+                f.write(chunk)
+                if verifier is not None:
+                    verifier.update(chunk)
+
+    # A short read keeps its partial file so the retry only asks for the rest
+    written = os.path.getsize(part_name)
+    if size is not None and written != size:
+        if written > size:
+            os.remove(part_name)
+        raise SegmentError(f"Segment {link} is {written} bytes, expected {size}")
+    if verifier is not None and not verifier.complete():
+        os.remove(part_name)
+        raise SegmentError(f"Segment {link} is not a valid transport stream")
+    os.replace(part_name, file_path)
+    return os.path.getsize(file_path)
\ No newline at end of file
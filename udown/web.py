@@ -1,11 +1,11 @@
 import undetected_chromedriver as webdriver
 from loguru import logger
-import json
-import os
 import time
+import threading
+import contextlib
 
 from utils import rand_input_delay
-from settings import SettingsManager, CacheRole
+from settings import SettingsManager, CacheRole, parse_cookies
 
 import undetected_chromedriver as webdriver
 from selenium.webdriver.chrome.service import Service
@@ -13,6 +13,11 @@ from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
 
+# The driver is shared by every lesson worker but selenium is not thread safe
+_driver_lock = threading.Lock()
+
+API_ORIGIN = "https://www.udemy.com"
+
 def wait_until_element_loads(driver:webdriver, parameter, query:str, is_array:bool=False) -> WebElement | tuple[WebElement]:
     if is_array:
         call_function = driver.find_elements
@@ -39,7 +44,7 @@ def suppress_exception_in_del(uc:webdriver) -> None:
     setattr(uc.Chrome, '__del__', new_del)
 
 
-def setup_selenium(webdriver_path:str, browser_binary:str) -> webdriver:
+def setup_selenium(webdriver_path:str, browser_binary:str, headless:bool=False) -> webdriver:
     suppress_exception_in_del(webdriver)
 
     service = Service(executable_path=webdriver_path)
@@ -47,12 +52,78 @@ def setup_selenium(webdriver_path:str, browser_binary:str) -> webdriver:
 
     options.binary_location = browser_binary
     options.add_argument("--disable-blink-features=AutomationControlled")
-    driver = webdriver.Chrome(service=service, options=options)
+    if headless:
+        options.add_argument("--window-size=1920,1080")
+    driver = webdriver.Chrome(service=service, options=options, headless=headless)
 
     return driver
 
 
+def load_cookies(driver:webdriver, cookies:tuple[dict]) -> None:
+    driver.get("https://udemy.com")
+
+    for cookie in cookies:
+        if 'sameSite' in cookie:
+            if cookie['sameSite'] in ('strict', 'lax'):
+                cookie['sameSite'] = cookie['sameSite'].title()
+            else:
+                cookie['sameSite'] = 'None'
+        driver.add_cookie(cookie)
+    driver.refresh()
+    logger.debug("Loaded cookies")
+
+
+def start_browser(settings:SettingsManager) -> webdriver:
+    driver = setup_selenium(settings.selenium.webdriver_path, settings.selenium.browser_path, settings.selenium.headless)
+    logger.debug("Created driver instance")
+
+    if settings.auth == 'password':
+        authenticate_user(driver, settings.credentials.email, settings.credentials.password)
+    elif settings.auth == 'cookies':
+        load_cookies(driver, parse_cookies(settings.cookies_file))
+    return driver
+
+
+# Stands in for the driver and only launches the browser once something
+# actually needs it, so fully cached runs never start one.
+class LazyDriver():
+    def __init__(self, settings:SettingsManager) -> None:
+        self._settings = settings
+        self._driver = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self._driver is not None
+
+    def get_driver(self) -> webdriver:
+        with self._lock:
+            if self._driver is None:
+                logger.info("Starting browser")
+                self._driver = start_browser(self._settings)
+        return self._driver
+
+    def __getattr__(self, name:str):
+        return getattr(self.get_driver(), name)
+
+    def close(self) -> None:
+        if self.started:
+            self._driver.close()
+
+    def quit(self) -> None:
+        if self.started:
+            self._driver.quit()
+
+
+def rebase_url(request_url:str, settings:SettingsManager=None) -> str:
+    # Lets the api be served from somewhere else, such as the benchmark server
+    if settings is None or settings.api_base_url == API_ORIGIN or not request_url.startswith(API_ORIGIN):
+        return request_url
+    return settings.api_base_url.rstrip('/') + request_url[len(API_ORIGIN):]
+
+
 def request_xhr(driver:webdriver, request_url:str, settings:SettingsManager=None, cache_role:CacheRole=None, cache_id:str=None) -> dict:
+    request_url = rebase_url(request_url, settings)
     logger.debug(request_url)
     use_cache = False
     if None not in (settings, cache_role, cache_id):
@@ -60,29 +131,114 @@ def request_xhr(driver:webdriver, request_url:str, settings:SettingsManager=None
         logger.debug(c_)
         if c_.enabled:
             use_cache = True
-            cache_location = os.path.join(settings.cache.directory, cache_role.name, str(cache_id))+'.json'
-            logger.debug(cache_location)
-            try:                                
-                with open(cache_location, 'r') as f:
-                    cached_content = f.read()
-            except FileNotFoundError:
+            cached_content = settings.cache.read(cache_role, cache_id)
+            if cached_content is None:
                 logger.debug(f"Cache empty for {cache_role}: {cache_id}")
             else:
                 logger.debug(f"Using cache at {cache_role}: {cache_id}")
-                return json.loads(cached_content)
+                return cached_content
 
 
-    if 'udemy.com' not in driver.current_url:
-        driver.get("https://udemy.com")
-        rand_input_delay(2)
-    
-    fetch_script = 'fetch("' + request_url + '", {' + settings.xhr_headers + """,
+    with settings.metrics.stage("xhr") if settings is not None else contextlib.nullcontext():
+        if settings is not None and settings.api_client is not None:
+            async_result = settings.api_client.get_json(request_url)
+        else:
+            with _driver_lock:
+                async_result = _execute_fetch(driver, request_url, settings)
+
+    # Dump cache, failed requests resolve to null and are not worth keeping
+    if use_cache and async_result is not None:
+        settings.cache.write(cache_role, cache_id, async_result)
+        logger.info(f"Dumped cache for {cache_role}:{cache_id}")
+
+    return async_result
+
+
+def request_xhr_batch(driver:webdriver, request_urls:dict[str, str], settings:SettingsManager, cache_role:CacheRole=None, concurrency:int=8, batch_size:int=64) -> dict[str, dict]:
+    results = {}
+    use_cache = cache_role is not None and settings.cache.get(cache_role).enabled
+
+    if use_cache:
+        results = settings.cache.read_many(cache_role, list(request_urls))
+        logger.debug(f"Cache has {len(results)}/{len(request_urls)} entries for {cache_role}")
+
+    missing = [id for id in map(str, request_urls) if id not in results]
+    request_urls = {str(id): rebase_url(url, settings) for id, url in request_urls.items()}
+
+    # Every batch is a single script run in the browser, which keeps at most
+    # `concurrency` fetches in flight and resolves once all of them settle.
+    for start in range(0, len(missing), batch_size):
+        batch = {id: request_urls[id] for id in missing[start:start+batch_size]}
+        logger.debug(f"Requesting {len(batch)} urls in one batch")
+
+        with settings.metrics.stage("xhr_batch"):
+            if settings.api_client is not None:
+                fetched = settings.api_client.get_json_many(batch, concurrency)
+            else:
+                with _driver_lock:
+                    fetched = _execute_fetch_batch(driver, batch, settings, concurrency)
+
+        fetched = {id: data for id, data in fetched.items() if data is not None}
+        if use_cache:
+            settings.cache.write_many(cache_role, fetched)
+            logger.info(f"Dumped cache for {len(fetched)} {cache_role} entries")
+        results.update(fetched)
+
+    return results
+
+
+def _fetch_options(settings:SettingsManager) -> str:
+    return '{' + settings.xhr_headers + """,
   "referrerPolicy": "strict-origin-when-cross-origin",
   "body": null,
   "method": "GET",
   "mode": "cors",
   "credentials": "include"
-})
+}"""
+
+
+def _open_origin(driver:webdriver) -> None:
+    if 'udemy.com' not in driver.current_url:
+        driver.get("https://udemy.com")
+        rand_input_delay(2)
+
+
+def _execute_fetch_batch(driver:webdriver, request_urls:dict[str, str], settings:SettingsManager, concurrency:int) -> dict[str, dict]:
+    _open_origin(driver)
+
+    fetch_script = """
+const urls = arguments[0];
+const limit = arguments[1];
+const done = arguments[arguments.length - 1];
+const options = """ + _fetch_options(settings) + """;
+const ids = Object.keys(urls);
+const results = {};
+let next = 0;
+
+async function worker() {
+  while (next < ids.length) {
+    const id = ids[next++];
+    try {
+      const response = await fetch(urls[id], options);
+      results[id] = await response.json();
+    } catch (error) {
+      console.error('Error:', error);
+      results[id] = null;
+    }
+  }
+}
+
+Promise.all(Array.from({length: Math.min(limit, ids.length)}, worker))
+  .then(() => done(results));
+"""
+
+    return driver.execute_async_script(fetch_script, request_urls, concurrency) or {}
+
+
+def _execute_fetch(driver:webdriver, request_url:str, settings:SettingsManager) -> dict:
+    _open_origin(driver)
+    
+    fetch_script = 'fetch("' + request_url + '", ' + _fetch_options(settings) + """)
 .then(response => response.json())
 .then(data => {
   arguments[0](data);  // Resolving the promise with data
@@ -93,15 +249,7 @@ def request_xhr(driver:webdriver, request_url:str, settings:SettingsManager=None
 });
 """
 
-    async_result = driver.execute_async_script(fetch_script)
-
-    # Dump cache
-    if use_cache:
-        with open(cache_location, 'w') as f:
-            f.write(json.dumps(async_result))
-        logger.info(f"Dumped cache for {cache_role}:{cache_id}")
-
-    return async_result
+    return driver.execute_async_script(fetch_script)
 
 
 def authenticate_user(driver: webdriver, email:str, password:str) -> None: